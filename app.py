@@ -3,7 +3,14 @@ import logging
 import requests
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Header, Response, Request
-from bot import init_bot, handle_webhook, health_check as bot_health_check
+from bot import init_bot, close_bot, handle_webhook, health_check as bot_health_check
+from update_queue import create_update_queue, UPDATE_DRAIN_TIMEOUT
+from dedup import update_deduplicator
+from settings_store import settings_store
+from redis_client import close_redis_client
+from audio_cache import audio_cache
+from rate_limiter import chat_scheduler, tts_scheduler
+import metrics
 from typing import Annotated
 
 # Configure logging to console
@@ -31,10 +38,22 @@ def get_webhook_url():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting Essay2Anki Bot...")
-    init_bot(get_webhook_url())
+    update_queue.start()
+    await init_bot(get_webhook_url())
     yield
     logger.info("Shutting down Essay2Anki Bot...")
+    await update_queue.stop(UPDATE_DRAIN_TIMEOUT)
+    await settings_store.close()
+    await close_redis_client()
+    await close_bot()
 
+# with a shared queue the updates are processed by worker.py, possibly on other nodes
+update_queue = create_update_queue(handle_webhook)
+metrics.UPDATE_QUEUE_SIZE.set_function(update_queue.qsize)
+metrics.SCHEDULER_QUEUED.labels("chat").set_function(chat_scheduler.queued)
+metrics.SCHEDULER_QUEUED.labels("tts").set_function(tts_scheduler.queued)
+metrics.AUDIO_CACHE_BYTES.set_function(lambda: audio_cache.stats()["bytes"])
+metrics.AUDIO_CACHE_ENTRIES.set_function(lambda: audio_cache.stats()["entries"])
 app = FastAPI(title="Essay2Anki Bot API", lifespan=lifespan)
 
 @app.middleware("http")
@@ -50,15 +69,33 @@ async def root():
     return "Essay2Anki Bot is running"
 
 @app.post("/webhook")
-def webhook(message: dict, x_telegram_bot_api_secret_token: Annotated[str, Header()]):
+async def webhook(message: dict, x_telegram_bot_api_secret_token: Annotated[str, Header()]):
     if x_telegram_bot_api_secret_token != os.getenv("ESSAY2ANKI_SECRET_TOKEN"):
         return Response(status_code=403)
     logger.debug(f"Received message: {message}")
-    handle_webhook(message)
+    with metrics.timed("webhook"):
+        if await update_deduplicator.is_duplicate(message):
+            metrics.SUPPRESSED_UPDATES.inc()
+            return
+        try:
+            accepted = await update_queue.submit(message)
+        except Exception as e:
+            logger.error(f"Failed to enqueue update {message.get('update_id')}: {e}", exc_info=True)
+            accepted = False
+        if not accepted:
+            # otherwise Telegram's redelivery would be suppressed as a duplicate
+            await update_deduplicator.forget(message)
+            metrics.REJECTED_UPDATES.inc()
+            return Response(status_code=503)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
 
 @app.get("/health")
 async def health_check():
-    if not bot_health_check():
+    if not await bot_health_check():
         return Response(content={"status": "unhealthy"}, status_code=500)
     return {"status": "healthy"}
 
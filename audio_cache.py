@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from hashlib import sha256
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+AUDIO_CACHE_DIR = os.getenv("ESSAY2ANKI_AUDIO_CACHE_DIR", "cache/audio")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("ESSAY2ANKI_AUDIO_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+class AudioCache:
+    """Content-addressed on-disk store of synthesized audio with LRU eviction.
+
+    Entries are keyed by everything that affects the synthesized sound, so a hit
+    can be handed out instead of calling the TTS API again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(text: str, voice: str, instructions: str, model: str, audio_format: str = "mp3") -> str:
+        parts = [text, voice, instructions, model]
+        # mp3 keys are the same as before the format was configurable, so the cached audio stays valid
+        if audio_format != "mp3":
+            parts.append(audio_format)
+        return sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        logger.info(f"Audio cache loaded: {len(self._entries)} entries, {self._size} bytes")
+
+    def get(self, key: str, filename: str) -> bool:
+        """Copies the cached audio for `key` to `filename`, returns False on a miss."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            shutil.copyfile(self._path(key), filename)
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return False
+        return True
+
+    def put(self, key: str, filename: str):
+        if not self.enabled:
+            return
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self._size > self.max_bytes:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._size}
+
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
@@ -0,0 +1,47 @@
+"""Per-request Anki deck setup cost: a fresh collection versus a copy of the template.
+
+    python bench/deck_setup.py --iterations 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+from anki.collection import Collection
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from deck_builder import DeckBuilder, COLLECTION_FILENAME, collection_template  # noqa: E402
+
+
+def fresh(directory: str):
+    Collection(os.path.join(directory, COLLECTION_FILENAME)).close()
+
+
+def from_template(directory: str):
+    DeckBuilder(directory).close()
+
+
+def measure(setup, iterations: int) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        with tempfile.TemporaryDirectory() as directory:
+            started = time.perf_counter()
+            setup(directory)
+            timings.append(time.perf_counter() - started)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    # load the backend and build the template outside of the measurements
+    collection_template()
+    print(f"{'setup':>10} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, setup in (("fresh", fresh), ("template", from_template)):
+        timings = measure(setup, args.iterations)
+        p95 = statistics.quantiles(timings, n=20)[18]
+        print(f"{name:>10} {statistics.mean(timings) * 1000:>9.2f} {statistics.median(timings) * 1000:>9.2f} {p95 * 1000:>9.2f}")
@@ -0,0 +1,327 @@
+"""Local stand-in for Redis, speaking enough of its protocol for the bot's shared stores and update queue.
+
+Only RESP2 is spoken, clients connect with a `?protocol=2` URL.
+"""
+import time
+import asyncio
+import fnmatch
+
+
+class FakeRedis:
+    """In-memory Redis server handling the commands the bot uses, with key expiry and BLPOP."""
+
+    def __init__(self):
+        self._data: dict[str, object] = {}
+        self._expires: dict[str, float] = {}
+        self._pushed = asyncio.Condition()
+        self.commands = 0
+
+    def _get(self, key: str, kind: type, create: bool = False):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at < time.time():
+            self._data.pop(key, None)
+            del self._expires[key]
+        value = self._data.get(key)
+        if value is None and create:
+            value = self._data[key] = kind()
+        if value is not None and not isinstance(value, kind):
+            raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _delete(self, key: str) -> int:
+        self._expires.pop(key, None)
+        return int(self._data.pop(key, None) is not None)
+
+    def _drop_if_empty(self, key: str):
+        if not self._data.get(key):
+            self._delete(key)
+
+    async def execute(self, name: str, *args: str):
+        self.commands += 1
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            raise ValueError(f"ERR unknown command '{name}'")
+        result = handler(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def cmd_ping(self, *args):
+        return b"PONG"
+
+    def cmd_client(self, *args):
+        return b"OK"
+
+    def cmd_select(self, db):
+        return b"OK"
+
+    def cmd_flushall(self, *args):
+        self._data.clear()
+        self._expires.clear()
+        return b"OK"
+
+    def cmd_keys(self, pattern):
+        return [key for key in list(self._data) if fnmatch.fnmatchcase(key, pattern) and self._get(key, object) is not None]
+
+    def cmd_get(self, key):
+        return self._get(key, str)
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        expires_at = None
+        for unit, scale in (("EX", 1), ("PX", 0.001)):
+            if unit in options:
+                expires_at = time.time() + float(options[options.index(unit) + 1]) * scale
+        if "NX" in options and self._get(key, object) is not None:
+            return None
+        self._delete(key)
+        self._data[key] = value
+        if expires_at is not None:
+            self._expires[key] = expires_at
+        return b"OK"
+
+    def cmd_mget(self, *keys):
+        return [self._get(key, str) for key in keys]
+
+    def cmd_expire(self, key, seconds):
+        if self._get(key, object) is None:
+            return 0
+        self._expires[key] = time.time() + float(seconds)
+        return 1
+
+    def cmd_pttl(self, key):
+        if self._get(key, object) is None:
+            return -2
+        if key not in self._expires:
+            return -1
+        return max(0, int((self._expires[key] - time.time()) * 1000))
+
+    def cmd_del(self, *keys):
+        return sum(self._delete(key) for key in keys)
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, "1")
+
+    def cmd_decr(self, key):
+        return self.cmd_incrby(key, "-1")
+
+    def cmd_decrby(self, key, amount):
+        return self.cmd_incrby(key, str(-int(amount)))
+
+    def cmd_incrby(self, key, amount):
+        value = int(self._get(key, str) or 0) + int(amount)
+        # unlike SET, keeps the expiry of the key
+        self._data[key] = str(value)
+        return value
+
+    def cmd_hset(self, key, *pairs):
+        fields = self._get(key, dict, create=True)
+        added = sum(pairs[i] not in fields for i in range(0, len(pairs), 2))
+        fields.update(zip(pairs[::2], pairs[1::2]))
+        return added
+
+    def cmd_hgetall(self, key):
+        fields = self._get(key, dict) or {}
+        return [item for pair in fields.items() for item in pair]
+
+    def cmd_hincrby(self, key, field, amount):
+        fields = self._get(key, dict, create=True)
+        fields[field] = str(int(fields.get(field, 0)) + int(amount))
+        return int(fields[field])
+
+    def cmd_hdel(self, key, *fields):
+        items = self._get(key, dict) or {}
+        removed = sum(items.pop(field, None) is not None for field in fields)
+        self._drop_if_empty(key)
+        return removed
+
+    async def cmd_rpush(self, key, *values):
+        items = self._get(key, list, create=True)
+        items.extend(values)
+        async with self._pushed:
+            self._pushed.notify_all()
+        return len(items)
+
+    def cmd_lpop(self, key):
+        items = self._get(key, list)
+        if not items:
+            return None
+        value = items.pop(0)
+        self._drop_if_empty(key)
+        return value
+
+    def cmd_lindex(self, key, index):
+        items = self._get(key, list) or []
+        try:
+            return items[int(index)]
+        except IndexError:
+            return None
+
+    def cmd_llen(self, key):
+        return len(self._get(key, list) or [])
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self._get(key, list) or []
+        stop = int(stop) + 1 or len(items)
+        items[:] = items[int(start):stop]
+        self._drop_if_empty(key)
+        return b"OK"
+
+    async def cmd_blpop(self, *args):
+        *keys, timeout = args
+        deadline = time.monotonic() + float(timeout) if float(timeout) else None
+        while True:
+            for key in keys:
+                value = self.cmd_lpop(key)
+                if value is not None:
+                    return [key, value]
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                return None
+            async with self._pushed:
+                try:
+                    await asyncio.wait_for(self._pushed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    def cmd_sadd(self, key, *members):
+        items = self._get(key, set, create=True)
+        added = len(set(members) - items)
+        items.update(members)
+        return added
+
+    def cmd_srem(self, key, *members):
+        items = self._get(key, set) or set()
+        removed = len(items & set(members))
+        items.difference_update(members)
+        self._drop_if_empty(key)
+        return removed
+
+    def cmd_zadd(self, key, *args):
+        flags = set()
+        while args and args[0].upper() in ("XX", "NX", "CH"):
+            flags.add(args[0].upper())
+            args = args[1:]
+        scores = self._get(key, dict, create=True)
+        changed = 0
+        for score, member in zip(args[::2], args[1::2]):
+            if ("XX" in flags and member not in scores) or ("NX" in flags and member in scores):
+                continue
+            changed += member not in scores or ("CH" in flags and scores[member] != float(score))
+            scores[member] = float(score)
+        self._drop_if_empty(key)
+        return changed
+
+    def cmd_zrem(self, key, *members):
+        scores = self._get(key, dict) or {}
+        removed = sum(scores.pop(member, None) is not None for member in members)
+        self._drop_if_empty(key)
+        return removed
+
+    def _sorted(self, key: str) -> list[str]:
+        scores = self._get(key, dict) or {}
+        return [member for member, _ in sorted(scores.items(), key=lambda item: (item[1], item[0]))]
+
+    def _by_score(self, key: str, low: str, high: str) -> list[str]:
+        def bound(value):
+            return {"-inf": float("-inf"), "+inf": float("inf"), "inf": float("inf")}.get(value) or float(value)
+        scores = self._get(key, dict) or {}
+        return [member for member in self._sorted(key) if bound(low) <= scores[member] <= bound(high)]
+
+    def cmd_zrange(self, key, start, stop):
+        members = self._sorted(key)
+        stop = int(stop) + 1 or len(members)
+        return members[int(start):stop]
+
+    def cmd_zrangebyscore(self, key, low, high):
+        return self._by_score(key, low, high)
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        return self.cmd_zrem(key, *self._by_score(key, low, high))
+
+    def cmd_zmscore(self, key, *members):
+        scores = self._get(key, dict) or {}
+        return [repr(scores[member]) if member in scores else None for member in members]
+
+
+def encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bytes):
+        return b"+" + value + b"\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        data = value.encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+    if isinstance(value, Exception):
+        return b"-" + str(value).encode() + b"\r\n"
+    return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+
+
+async def read_command(reader: asyncio.StreamReader) -> list[str] | None:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.decode().split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2].decode())
+    return args
+
+
+async def serve(host: str = "127.0.0.1", port: int = 6379) -> tuple[asyncio.Server, FakeRedis]:
+    redis = FakeRedis()
+
+    async def execute(*command: str):
+        try:
+            return await redis.execute(*command)
+        except Exception as e:
+            return e if str(e).split(" ", 1)[0].isupper() else ValueError(f"ERR {e}")
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # commands of an open MULTI, run together by EXEC
+        transaction = None
+        try:
+            while (command := await read_command(reader)) is not None:
+                if not command:
+                    continue
+                name = command[0].upper()
+                if name == "MULTI":
+                    transaction, result = [], b"OK"
+                elif name == "EXEC" and transaction is not None:
+                    # nothing else runs in between, as none of the queued commands block
+                    result = [await execute(*queued) for queued in transaction]
+                    transaction = None
+                elif name == "DISCARD" and transaction is not None:
+                    transaction, result = None, b"OK"
+                elif transaction is not None:
+                    transaction.append(command)
+                    result = b"QUEUED"
+                else:
+                    result = await execute(*command)
+                writer.write(encode(result))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port), redis
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    async def main():
+        server, _ = await serve(port=args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""Local stand-ins for the OpenAI and Telegram Bot APIs used by the benchmark."""
+import re
+import json
+import time
+import asyncio
+
+from fastapi import FastAPI, Request, Response
+from starlette.datastructures import UploadFile
+from fastapi.responses import StreamingResponse
+
+# one silent MPEG-1 Layer III frame, 128 kbit/s 44.1 kHz
+MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+def create_fake_openai(chat_latency: float, token_interval: float, tts_latency: float, tts_bytes: int) -> FastAPI:
+    """OpenAI stand-in answering chat completions with canned structured translations of the prompt's text
+    and speech with silence."""
+    app = FastAPI()
+    audio = MP3_FRAME * max(1, tts_bytes // len(MP3_FRAME))
+
+    def translate(prompt: str, response_format: dict) -> str:
+        text = prompt.rsplit("Вот текст для перевода:\n", 1)[-1]
+        sentences = [s for s in re.split(r"(?<=[.!?])\s+", text.strip()) if s]
+        if response_format["json_schema"]["name"] == "phrases":
+            return json.dumps({"phrases": [
+                {"original": s, "translated": f"Μετάφραση: {s}", "instructions": "спокойно, дружелюбно"} for s in sentences
+            ]}, ensure_ascii=False)
+        return json.dumps({
+            "instructions": "спокойно, дружелюбно",
+            "translation": " ".join(f"Translation: {s}" for s in sentences),
+        }, ensure_ascii=False)
+
+    def chunk(delta: dict | None, usage: dict | None = None) -> str:
+        body = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": "gpt-4o",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}] if delta is not None else [],
+            "usage": usage,
+        }
+        return f"data: {json.dumps(body)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = body["messages"][-1]["content"]
+        answer = translate(prompt, body["response_format"])
+
+        async def stream():
+            await asyncio.sleep(chat_latency)
+            # roughly one token per 4 characters
+            for i in range(0, len(answer), 4):
+                yield chunk({"content": answer[i:i + 4]})
+                await asyncio.sleep(token_interval)
+            yield chunk(None, {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4,
+                               "total_tokens": (len(prompt) + len(answer)) // 4})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/v1/audio/speech")
+    async def speech(request: Request):
+        body = await request.json()
+        await asyncio.sleep(tts_latency)
+        # the audio is mp3 whatever the format, the bot does not look inside
+        return Response(audio, media_type="audio/ogg" if body.get("response_format") == "opus" else "audio/mpeg")
+
+    return app
+
+
+class TelegramRecorder:
+    """Resolves a waiter when the bot delivers the final reply to a chat."""
+
+    FINAL_METHODS = {"sendvoice", "senddocument"}
+
+    def __init__(self):
+        self._waiters: dict[int, asyncio.Future] = {}
+        self.calls: dict[str, int] = {}
+        self.uploaded_bytes: dict[str, int] = {}
+
+    def expect(self, chat_id: int) -> asyncio.Future:
+        self._waiters[chat_id] = asyncio.get_running_loop().create_future()
+        return self._waiters[chat_id]
+
+    def record(self, method: str, chat_id: int | None, text: str | None, uploaded: int = 0):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.uploaded_bytes[method] = self.uploaded_bytes.get(method, 0) + uploaded
+        waiter = self._waiters.get(chat_id)
+        if waiter is None or waiter.done():
+            return
+        if method in self.FINAL_METHODS:
+            waiter.set_result(True)
+        elif text and "попробуйте" in text:
+            waiter.set_result(False)
+
+
+def create_fake_telegram(recorder: TelegramRecorder) -> FastAPI:
+    """Telegram Bot API stand-in that accepts every call and reports it to the recorder."""
+    app = FastAPI()
+    message_ids = iter(range(1, 1 << 62))
+
+    def message(chat_id: int, **fields) -> dict:
+        return {"message_id": next(message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **fields}
+
+    @app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def call(method: str, request: Request):
+        form = await request.form()
+        method = method.lower()
+        chat_id = int(form["chat_id"]) if form.get("chat_id") else None
+        text = form.get("text")
+        uploaded = sum(value.size for value in form.values() if isinstance(value, UploadFile))
+        recorder.record(method, chat_id, text, uploaded)
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Essay2Anki", "username": "essay2anki_bot"}
+        elif method == "getmycommands":
+            result = []
+        elif method in ("sendmessage", "editmessagetext"):
+            result = message(chat_id, text=text)
+        elif method == "sendvoice":
+            result = message(chat_id, voice={"file_id": f"voice-{time.time_ns()}", "file_unique_id": "voice", "duration": 1})
+        elif method == "senddocument":
+            result = message(chat_id, document={"file_id": f"document-{time.time_ns()}", "file_unique_id": "document"})
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    return app
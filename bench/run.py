@@ -0,0 +1,249 @@
+"""Offline throughput benchmark of the bot.
+
+Runs the real FastAPI app in a subprocess against local stand-ins for the
+OpenAI and Telegram APIs, replays synthetic webhook updates from a number of
+concurrent chats and reports latency percentiles, throughput and peak RSS.
+
+    python bench/run.py --essays 200 --concurrency 32 --modes chat anki
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import aiohttp
+import uvicorn
+
+import fake_redis
+from fakes import TelegramRecorder, create_fake_openai, create_fake_telegram
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET_TOKEN = "bench"
+
+WORDS = ("the", "morning", "train", "was", "late", "again", "and", "nobody", "seemed", "surprised", "by", "it",
+         "my", "neighbour", "quietly", "opened", "a", "book", "about", "old", "maps", "while", "rain", "fell")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def essay(n: int, phrases: int) -> str:
+    """Synthetic essay, different for every `n` so that it is not served from the caches."""
+    sentences = []
+    for i in range(phrases):
+        words = [WORDS[(n * 7 + i * 3 + j * 5) % len(WORDS)] for j in range(8)]
+        sentences.append(f"{' '.join(words).capitalize()} {n}-{i}.")
+    return " ".join(sentences)
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "private"}, "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+    }}
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(chat_id), "data": data,
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        "message": {"message_id": 1, "date": int(time.time()), "text": "settings", "chat": {"id": chat_id, "type": "private"}},
+    }}
+
+
+def peak_rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+async def serve(app, port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+def app_env(port: int, openai_port: int, telegram_port: int, redis_port: int | None) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "ESSAY2ANKI_BOT_KEY": "0:bench",
+        "ESSAY2ANKI_OPENAI_KEY": "sk-bench",
+        "ESSAY2ANKI_SECRET_TOKEN": SECRET_TOKEN,
+        "ESSAY2ANKI_BOT_WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "ESSAY2ANKI_OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "ESSAY2ANKI_TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+    })
+    # the stand-ins have no rate limits, measure the bot rather than the scheduler unless asked to
+    for name in ("ESSAY2ANKI_CHAT_RPM", "ESSAY2ANKI_TTS_RPM", "ESSAY2ANKI_CHAT_TPM", "ESSAY2ANKI_TTS_TPM"):
+        env.setdefault(name, "100000000")
+    if redis_port:
+        env["ESSAY2ANKI_REDIS_URL"] = f"redis://127.0.0.1:{redis_port}/0?protocol=2"
+        for name in ("ESSAY2ANKI_QUEUE_BACKEND", "ESSAY2ANKI_CACHE_BACKEND", "ESSAY2ANKI_SETTINGS_BACKEND"):
+            env[name] = "redis"
+    return env
+
+
+def start_app(env: dict, port: int, workdir: str, log) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", REPO_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def start_worker(env: dict, workdir: str, log) -> subprocess.Popen:
+    # every worker gets its own directory, like a node of its own
+    os.makedirs(workdir)
+    return subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "worker.py")],
+                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_healthy(session: aiohttp.ClientSession, url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode}")
+        try:
+            async with session.get(url + "/health") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("App did not become healthy in time")
+
+
+async def run_mode(mode: str, args, session: aiohttp.ClientSession, url: str, recorder: TelegramRecorder, first_chat: int) -> dict:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN}
+    update_ids = iter(range(first_chat * 10, 1 << 62))
+    essays = iter(range(args.essays))
+    latencies = []
+    errors = 0
+
+    async def post(update: dict):
+        while True:
+            async with session.post(url + "/webhook", json=update, headers=headers) as response:
+                if response.status != 503:
+                    response.raise_for_status()
+                    return
+            # queue full, Telegram would redeliver later
+            await asyncio.sleep(0.05)
+
+    async def client():
+        nonlocal errors
+        for n in essays:
+            chat_id = first_chat + n
+            if mode == "anki":
+                await post(callback_update(next(update_ids), chat_id, "anki"))
+            done = recorder.expect(chat_id)
+            started = time.perf_counter()
+            text = essay(first_chat + n % (args.distinct or args.essays), args.phrases)
+            await post(message_update(next(update_ids), chat_id, text))
+            try:
+                ok = await asyncio.wait_for(done, args.timeout)
+            except asyncio.TimeoutError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    uploaded_before = sum(recorder.uploaded_bytes.values())
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "mode": mode,
+        "essays": args.essays,
+        "concurrency": args.concurrency,
+        "completed": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50": round(quantiles[49], 3) if quantiles else None,
+        "p95": round(quantiles[94], 3) if quantiles else None,
+        "p99": round(quantiles[98], 3) if quantiles else None,
+        "upload_kb": round((sum(recorder.uploaded_bytes.values()) - uploaded_before) / 1024 / max(1, len(latencies)), 1),
+    }
+
+
+async def main(args) -> list[dict]:
+    recorder = TelegramRecorder()
+    openai_port, telegram_port, app_port = free_port(), free_port(), free_port()
+    fake_openai = create_fake_openai(args.openai_latency, args.token_interval, args.tts_latency, args.tts_bytes)
+    servers = [await serve(fake_openai, openai_port), await serve(create_fake_telegram(recorder), telegram_port)]
+    redis_port = None
+    if args.workers:
+        redis_port = free_port()
+        redis_server, _ = await fake_redis.serve(port=redis_port)
+    url = f"http://127.0.0.1:{app_port}"
+    env = app_env(app_port, openai_port, telegram_port, redis_port)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, open(args.log, "w") as log:
+        processes = [start_app(env, app_port, workdir, log)]
+        processes += [start_worker(env, os.path.join(workdir, f"worker-{i}"), log) for i in range(args.workers)]
+        try:
+            connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await wait_healthy(session, url, processes[0])
+                for i, mode in enumerate(args.modes):
+                    result = await run_mode(mode, args, session, url, recorder, first_chat=(i + 1) * 10_000_000)
+                    # of all processes together
+                    result["peak_rss_mb"] = round(sum(peak_rss_kb(process.pid) for process in processes) / 1024, 1)
+                    results.append(result)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                # in a thread, the stand-ins must keep serving the processes while they shut down
+                await asyncio.to_thread(process.wait, 30)
+            if redis_port:
+                redis_server.close()
+            for server, task in servers:
+                server.should_exit = True
+                await task
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--essays", type=int, default=100, help="essays to translate per mode")
+    parser.add_argument("--concurrency", type=int, default=16, help="chats sending essays at the same time")
+    parser.add_argument("--modes", nargs="+", choices=("chat", "anki"), default=["chat", "anki"])
+    parser.add_argument("--distinct", type=int, help="cycle through this many different essays to exercise the caches")
+    parser.add_argument("--phrases", type=int, default=6, help="sentences per essay")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="seconds to the first chat completion token")
+    parser.add_argument("--token-interval", type=float, default=0.002, help="seconds between streamed tokens")
+    parser.add_argument("--tts-latency", type=float, default=0.4, help="seconds per speech request")
+    parser.add_argument("--tts-bytes", type=int, default=32_000, help="size of each synthesized audio file")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a single essay")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="process updates in this many worker.py processes, sharing state through a Redis stand-in")
+    parser.add_argument("--log", default="bench-app.log", help="file receiving the app's output")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    columns = ("mode", "completed", "errors", "throughput", "p50", "p95", "p99", "upload_kb", "peak_rss_mb")
+    print(" ".join(f"{c:>11}" for c in columns))
+    for result in results:
+        print(" ".join(f"{str(result[c]):>11}" for c in columns))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if any(result["errors"] for result in results) else 0)
@@ -1,30 +1,79 @@
 from functools import partial
 import os
 import re
+import httpx
 import openai
-import telebot
 import json
 import tempfile
 import logging
+import time
+import asyncio
+import shutil
 from hashlib import sha256
 from telebot.types import (
     ReplyParameters, Message,MenuButtonCommands, BotCommand,
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
     Update, BotCommandScopeChat)
-from telebot.util import antiflood
-
-from anki.collection import Collection, AddNoteRequest, ExportAnkiPackageOptions, DeckIdLimit
+from telebot.async_telebot import AsyncTeleBot
+from telebot.util import smart_split
+from telebot import asyncio_helper
+
+from tts_pool import speech_pool
+from audio_cache import audio_cache
+from cache import create_cache, CACHE_BACKEND
+from update_queue import update_chat_id, QUEUE_BACKEND
+from settings_store import settings_store
+from deck_builder import DeckBuilder, ChatDeck, COLLECTION_FILENAME, collection_template
+from chunking import split_text
+from phrases import Phrase, TranslationDelta, PhraseParser, SpeechParser, PHRASES_FORMAT, SPEECH_FORMAT, untranslated_tail
+from rate_limiter import chat_scheduler, tts_scheduler, current_chat_id, estimate_tokens
+from metrics import timed, STAGE_SECONDS, OPENAI_TOKENS, AUDIO_BYTES, CACHE_REQUESTS, PACKAGE_BYTES
 
 logger = logging.getLogger(__name__)
 
 # Configuration
 TELEGRAM_TOKEN = os.getenv("ESSAY2ANKI_BOT_KEY")
 OPENAI_API_KEY = os.getenv("ESSAY2ANKI_OPENAI_KEY")
+# alternative API endpoints, e.g. local stand-ins for benchmarks
+OPENAI_BASE_URL = os.getenv("ESSAY2ANKI_OPENAI_BASE_URL")
+TELEGRAM_API_URL = os.getenv("ESSAY2ANKI_TELEGRAM_API_URL")
+TRANSLATION_CACHE_TTL = float(os.getenv("ESSAY2ANKI_TRANSLATION_CACHE_TTL", str(24 * 60 * 60)))
+TRANSLATION_CACHE_CAPACITY = int(os.getenv("ESSAY2ANKI_TRANSLATION_CACHE_CAPACITY", "1000"))
+# file_ids of uploaded voices and decks stay valid for long, so they are persisted by default
+FILE_ID_CACHE_BACKEND = os.getenv("ESSAY2ANKI_FILE_ID_CACHE_BACKEND", "redis" if CACHE_BACKEND == "redis" else "sqlite")
+FILE_ID_CACHE_TTL = float(os.getenv("ESSAY2ANKI_FILE_ID_CACHE_TTL", str(90 * 24 * 60 * 60)))
+FILE_ID_CACHE_CAPACITY = int(os.getenv("ESSAY2ANKI_FILE_ID_CACHE_CAPACITY", "100000"))
+STREAM_EDIT_INTERVAL = float(os.getenv("ESSAY2ANKI_STREAM_EDIT_INTERVAL", "1.0"))
+TRANSLATION_CHUNK_SIZE = int(os.getenv("ESSAY2ANKI_TRANSLATION_CHUNK_SIZE", "1500"))
+TRANSLATION_CONCURRENCY = int(os.getenv("ESSAY2ANKI_TRANSLATION_CONCURRENCY", "8"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("ESSAY2ANKI_OPENAI_MAX_CONNECTIONS", "100"))
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("ESSAY2ANKI_TELEGRAM_MAX_CONNECTIONS", "100"))
+# formats requested from the TTS API, Telegram shows only ogg/opus files as voice messages
+VOICE_AUDIO_FORMAT = os.getenv("ESSAY2ANKI_VOICE_AUDIO_FORMAT", "opus")
+DECK_AUDIO_FORMAT = os.getenv("ESSAY2ANKI_DECK_AUDIO_FORMAT", "mp3")
+# the collections of collect mode live in the chats directory of the node, while with a shared queue the updates
+# of a chat are handled on any node, so the mode is only offered there if that directory is shared by all of them
+COLLECT_AVAILABLE = os.getenv("ESSAY2ANKI_COLLECT_AVAILABLE", "1" if QUEUE_BACKEND == "local" else "0") == "1"
 
 # Initialize APIs
 logger.info("Initializing Telegram bot and OpenAI client...")
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# both clients keep one pooled HTTP session for all requests of the process
+asyncio_helper.REQUEST_LIMIT = TELEGRAM_MAX_CONNECTIONS
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+bot = AsyncTeleBot(TELEGRAM_TOKEN)
+client = openai.AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=OPENAI_BASE_URL,
+    # retries go through the rate limiter, so that they respect the shared budget
+    max_retries=0,
+    http_client=openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS)
+    )
+)
+translation_cache = create_cache("translations", TRANSLATION_CACHE_TTL, TRANSLATION_CACHE_CAPACITY)
+file_id_cache = create_cache("file_ids", FILE_ID_CACHE_TTL, FILE_ID_CACHE_CAPACITY, FILE_ID_CACHE_BACKEND)
+translation_semaphore = asyncio.Semaphore(TRANSLATION_CONCURRENCY)
 available_languages = {
     "gr": "греческий",
     "sb": "сербский",
@@ -55,30 +104,76 @@ available_voices = {
 
 DEFAULT_LANGUAGE = "gr"
 DEFAULT_ANKI = False
+DEFAULT_COLLECT = False
 DEFAULT_VOICE = "ash"
 DEFAULT_INSTRUCTIONS = "спокойно, дружелюбно"
-
-
-def handle_error(input: Message | CallbackQuery, e: Exception):
+TTS_MODEL = "gpt-4o-mini-tts"
+TRANSLATION_MODEL = "gpt-4o"
+TRANSLATION_PROMPT_VERSION = 2
+MAX_TRANSLATION_LENGTH = 7000
+MAX_MESSAGE_LENGTH = 4096
+AUDIO_EXTENSIONS = {"mp3": "mp3", "opus": "ogg", "aac": "aac", "flac": "flac", "wav": "wav"}
+for audio_format in (VOICE_AUDIO_FORMAT, DECK_AUDIO_FORMAT):
+    if audio_format not in AUDIO_EXTENSIONS:
+        raise ValueError(f"Unsupported audio format: {audio_format}")
+
+
+async def handle_error(input: Message | CallbackQuery, e: Exception):
     logger.error(f"Error handling message: {e}", exc_info=True)
+    if isinstance(e, openai.RateLimitError):
+        text = "Сейчас слишком много запросов, попробуйте через минуту."
+    else:
+        text = "Произошла ошибка, попробуйте снова."
     if isinstance(input, CallbackQuery):
-        bot.edit_message_text(chat_id=input.message.chat.id, message_id=input.message.id, text="Произошла ошибка, попробуйте снова.")
+        await bot.edit_message_text(chat_id=input.message.chat.id, message_id=input.message.id, text=text)
     else:
-        bot.send_message(input.chat.id, "Произошла ошибка, попробуйте снова.")
+        await bot.send_message(input.chat.id, text)
 
 
 def handle_error_decorator(func):
-    def wrapper(message_or_callback: Message | CallbackQuery):
+    async def wrapper(message_or_callback: Message | CallbackQuery):
         try:
-            return func(message_or_callback)
+            return await func(message_or_callback)
         except Exception as e:
-            handle_error(message_or_callback, e)
+            await handle_error(message_or_callback, e)
     return wrapper
 
 
-def translate_text(text, settings):
-    """Uses ChatGPT to translate and structure text into standard Greek while keeping original phrases."""
-    prompt = (
+class TranslationTooLong(Exception):
+    pass
+
+
+class TranslationIncomplete(Exception):
+    """Part of the text could not be translated, even when requested again on its own."""
+
+
+def translation_cache_key(text, settings, context=None):
+    normalized_text = re.sub(r"\s+", " ", text).strip()
+    normalized_context = re.sub(r"\s+", " ", context).strip() if context else None
+    return sha256(json.dumps([
+        TRANSLATION_MODEL, TRANSLATION_PROMPT_VERSION,
+        settings["language"], settings["gender"], settings["anki"], normalized_text, normalized_context
+    ], ensure_ascii=False).encode()).hexdigest()
+
+
+def split_translation_chunks(text):
+    """Returns (chunk, context) pairs, every chunk is translated with the chunk before it as context."""
+    chunks = split_text(text, TRANSLATION_CHUNK_SIZE)
+    return list(zip(chunks, [None] + chunks[:-1]))
+
+
+async def forget_translation(text, settings):
+    """Drops a cached translation that turned out to be unusable, so that a retry asks the model again."""
+    for chunk, context in split_translation_chunks(text):
+        await translation_cache.delete(translation_cache_key(chunk, settings, context))
+
+
+def translation_prompt(text, settings, context=None):
+    context_note = (
+        "Это продолжение длинного текста. Вот его предыдущая часть для контекста, "
+        f"её переводить не нужно:\n{context}\n"
+    ) if context else ""
+    return (
         f"Переведи на стандартный современный {available_languages[settings['language']]} язык "
         "с соблюдением всех грамматических норм, сохраняя "
         "исходный стиль написания и уровень используемой лексики. "
@@ -95,19 +190,19 @@ def translate_text(text, settings):
         "Если в тексте описываются опасные события, то дай инструкцию сделать голос более тревожным."
         "Если в тексте описываются нейтральные события, то дай инструкцию сделать голос спокойным и дружелюбным."
         f"Пол автора текста: {settings['gender']}"
-        "Строго напиши ответ в формате .csv с разделителем ; для импорта в Anki:\n"
-        "отрывок из оригинала;переведённый отрывок;инструкция для tts генератора\n"
-        "Например:\n"
-        "\"Это текст для перевода. Он состоит из двух отрывков.\". Ответ:\n"
-        "Это текст для перевода;Αυτό είναι το κείμενο για μετάφραση;спокойно, дружелюбно.\n"
-        "Я был так напуган;I was so scared;тревожно, напуганно.\n"
-        f"Вот текст для перевода:\n{text}"
+        "Для каждого отрывка в поле original напиши отрывок из оригинала, в поле translated - "
+        "переведённый отрывок, в поле instructions - инструкцию для tts генератора.\n"
+        "Например, для текста \"Это текст для перевода. Я был так напуган.\" отрывки:\n"
+        "original: Это текст для перевода. translated: Αυτό είναι το κείμενο για μετάφραση. instructions: спокойно, дружелюбно\n"
+        "original: Я был так напуган. translated: Ήμουν τόσο φοβισμένος. instructions: тревожно, напуганно\n"
+        f"{context_note}Вот текст для перевода:\n{text}"
     ) if settings["anki"] else (
         f"Переведи на стандартный современный {available_languages[settings['language']]} язык "
         "с соблюдением всех грамматических норм, сохраняя "
         "исходный стиль написания и уровень используемой лексики. "
         "Ответ сделай максимально компактным, не добавляя лишнего текста. "
-        "В скобках напиши инструкцию для tts генератора, чтобы он читал текст с определённым настроем."
+        "В поле instructions напиши инструкцию для tts генератора, чтобы он читал текст с определённым настроем, "
+        "в поле translation - перевод."
         "Например, если в тексте есть юмор, то дай инструкию сделать голос весёлым."
         "Или если в тексте есть вопрос, то дай инструкцию сделать голос с вопросительной интонацией."
         "Если в тексте описываются чувства, то дай инструкцию сделать голос более эмоциональным."
@@ -116,103 +211,387 @@ def translate_text(text, settings):
         "Если в тексте описываются опасные события, то дай инструкцию сделать голос более тревожным."
         "Если в тексте описываются нейтральные события, то дай инструкцию сделать голос спокойным и дружелюбным."
         f"Пол автора текста: {settings['gender']}"
-        "Пример перевода:\n"
-        "\"Я был так напуган. Это мой первый полёт.\" -> \"(встревоженно, эмоционально) I was so scared. This is my first flight.\"\n"
-        f"Вот текст для перевода:\n{text}"
+        "Пример перевода текста \"Я был так напуган. Это мой первый полёт.\":\n"
+        "instructions: встревоженно, эмоционально translation: I was so scared. This is my first flight.\n"
+        f"{context_note}Вот текст для перевода:\n{text}"
     )
-    response = client.chat.completions.create(
-        model="gpt-4o",
+
+
+async def request_translation(text, settings, context=None):
+    """Uses ChatGPT to translate and structure text into standard Greek while keeping original phrases.
+    Yields the raw JSON answer in pieces as the model produces them."""
+    prompt = translation_prompt(text, settings, context)
+    # the answer repeats the original text next to its translation
+    tokens = estimate_tokens(prompt) + 2 * estimate_tokens(text)
+    started = time.monotonic()
+    response = await chat_scheduler.run(
+        tokens,
+        client.chat.completions.create,
+        model=TRANSLATION_MODEL,
         messages=[{"role": "user", "content": prompt}],
-        temperature=0.9
+        response_format=PHRASES_FORMAT if settings["anki"] else SPEECH_FORMAT,
+        temperature=0.9,
+        stream=True,
+        stream_options={"include_usage": True}
     )
-    return response.choices[0].message.content
+    try:
+        length = 0
+        async for chunk in response:
+            if chunk.usage:
+                OPENAI_TOKENS.labels(TRANSLATION_MODEL, "prompt").inc(chunk.usage.prompt_tokens)
+                OPENAI_TOKENS.labels(TRANSLATION_MODEL, "completion").inc(chunk.usage.completion_tokens)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if not length:
+                    STAGE_SECONDS.labels("translate_first_delta").observe(time.monotonic() - started)
+                length += len(delta)
+                if length > MAX_TRANSLATION_LENGTH:
+                    raise TranslationTooLong()
+                yield delta
+    finally:
+        await response.close()
+    STAGE_SECONDS.labels("translate").observe(time.monotonic() - started)
+
+
+async def stream_chunk_speech(text, settings, context=None):
+    """Chat mode: yields the translation of one chunk in pieces as the model writes it."""
+    cache_key = translation_cache_key(text, settings, context)
+    cached = await translation_cache.get(cache_key)
+    if cached is not None:
+        logger.debug("Translation cache hit")
+        CACHE_REQUESTS.labels("translation", "hit").inc()
+        yield TranslationDelta(**json.loads(cached))
+        return
+    CACHE_REQUESTS.labels("translation", "miss").inc()
+
+    parser = SpeechParser()
+    async for delta in request_translation(text, settings, context):
+        piece = parser.feed(delta)
+        if piece:
+            yield TranslationDelta(parser.instructions, piece)
+    if parser.translation.strip():
+        await translation_cache.set(cache_key, json.dumps({"instructions": parser.instructions, "text": parser.translation}, ensure_ascii=False))
+
+
+async def translate_phrases(text, settings):
+    """Anki mode: translates text in a single request, returns only the valid phrases."""
+    parser = PhraseParser()
+    phrases = []
+    async for delta in request_translation(text, settings):
+        phrases += parser.feed(delta)
+    phrases += parser.close()
+    return [phrase for phrase in phrases if phrase.valid]
+
+
+async def stream_chunk_phrases(text, settings, context=None):
+    """Anki mode: yields the phrases of one chunk as soon as the model completes each of them.
+
+    Phrases the model got wrong, and the rest of the text if its answer broke off,
+    are requested again on their own rather than retranslating the whole chunk.
+    Phrases after such a gap are held back until it is filled, to keep their order.
+    Raises `TranslationIncomplete` rather than leaving out a part that still fails,
+    only complete translations are cached.
+    """
+    cache_key = translation_cache_key(text, settings, context)
+    cached = await translation_cache.get(cache_key)
+    if cached is not None:
+        logger.debug("Translation cache hit")
+        CACHE_REQUESTS.labels("translation", "hit").inc()
+        for phrase in json.loads(cached):
+            yield Phrase(*phrase)
+        return
+    CACHE_REQUESTS.labels("translation", "miss").inc()
+
+    parser = PhraseParser()
+    # phrases, and original texts that have to be translated again in their place
+    slots: list[Phrase | str] = []
+    yielded = 0
+    lost = False
+
+    def take(phrases):
+        nonlocal lost
+        for phrase in phrases:
+            if phrase.valid:
+                slots.append(phrase)
+            elif phrase.original:
+                slots.append(phrase.original)
+            elif phrase.translated:
+                # there is no telling which part of the text it translates
+                logger.warning(f"Got a phrase without original text: {phrase}")
+                lost = True
+
+    async for delta in request_translation(text, settings, context):
+        take(parser.feed(delta))
+        while yielded < len(slots) and isinstance(slots[yielded], Phrase):
+            yield slots[yielded]
+            yielded += 1
+    take(parser.close())
+    if not parser.complete:
+        tail = untranslated_tail(text, [slot.original if isinstance(slot, Phrase) else slot for slot in slots])
+        if tail is None:
+            logger.warning("The translation broke off after a phrase that is not in the text")
+            lost = True
+        elif tail:
+            slots.append(tail)
+    if lost:
+        raise TranslationIncomplete()
+
+    gaps = [slot for slot in slots if isinstance(slot, str)]
+    if gaps:
+        logger.warning(f"Requesting {len(gaps)} invalid or missing parts of the translation again")
+        retranslated = await asyncio.gather(*[translate_phrases(gap, settings) for gap in gaps])
+        if not all(retranslated):
+            logger.warning(f"{sum(not phrases for phrases in retranslated)} parts of the translation failed again")
+            raise TranslationIncomplete()
+        retranslated = iter(retranslated)
+        # gaps only start at or after the phrases already yielded, so these keep their positions
+        slots = [phrase for slot in slots for phrase in (next(retranslated) if isinstance(slot, str) else [slot])]
+    for phrase in slots[yielded:]:
+        yield phrase
+    if slots:
+        await translation_cache.set(cache_key, json.dumps(slots, ensure_ascii=False))
+
+
+async def _pump_translation(stream, output: asyncio.Queue):
+    try:
+        async with translation_semaphore:
+            async for item in stream:
+                output.put_nowait(item)
+    except Exception as e:
+        output.put_nowait(e)
+    finally:
+        output.put_nowait(None)
+
+
+async def stream_translation(text, settings, stream_chunk, separator=None):
+    """Translates long texts chunk by chunk in parallel with `stream_chunk`, yielding its items in the original order.
+    The first chunk is streamed live, later chunks are buffered until all chunks before them are done."""
+    chunks = split_translation_chunks(text)
+    if len(chunks) == 1:
+        async for item in stream_chunk(text, settings):
+            yield item
+        return
 
+    outputs = [asyncio.Queue() for _ in chunks]
+    pumps = [asyncio.create_task(_pump_translation(stream_chunk(chunk, settings, context), output))
+             for (chunk, context), output in zip(chunks, outputs)]
+    try:
+        for i, output in enumerate(outputs):
+            if i and separator is not None:
+                yield separator
+            while (item := await output.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        for pump in pumps:
+            pump.cancel()
+
+
+def stream_speech_translation(text, settings):
+    """Chat mode: yields `TranslationDelta`s of the whole text, chunks are separated by newlines."""
+    return stream_translation(text, settings, stream_chunk_speech, separator=TranslationDelta("", "\n"))
+
+
+def stream_phrases(text, settings):
+    """Anki mode: yields the `Phrase`s of the whole text."""
+    return stream_translation(text, settings, stream_chunk_phrases)
+
+
+class ProgressiveReply:
+    """Reply to a message that is edited in place as more of its text becomes available.
+
+    Text longer than Telegram allows in one message continues in follow-up messages.
+    """
+
+    def __init__(self, message: Message, parse_mode: str | None = None):
+        self._message = message
+        self._parse_mode = parse_mode
+        self._text = ""
+        self._sent: list[tuple[int, str]] = []
+        self._last_flush = 0.0
+
+    async def update(self, text: str):
+        self._text = text
+        if time.monotonic() - self._last_flush >= STREAM_EDIT_INTERVAL:
+            await self.flush()
+
+    async def flush(self):
+        self._last_flush = time.monotonic()
+        text = self._text.strip()
+        if not text:
+            return
+        for i, part in enumerate(smart_split(text, MAX_MESSAGE_LENGTH)):
+            if i == len(self._sent):
+                sent = await bot.send_message(self._message.chat.id, part, parse_mode=self._parse_mode,
+                    reply_parameters=ReplyParameters(self._message.id, allow_sending_without_reply=True))
+                self._sent.append((sent.message_id, part))
+            elif self._sent[i][1] != part:
+                await bot.edit_message_text(part, chat_id=self._message.chat.id, message_id=self._sent[i][0],
+                    parse_mode=self._parse_mode)
+                self._sent[i] = (self._sent[i][0], part)
+
+
+async def synthesize_speech(text, instructions, filename, settings, audio_format="mp3"):
+    """Converts text to speech using OpenAI TTS and saves it in `audio_format`, reusing cached audio when possible.
+
+    The audio is written under a temporary name first, so `filename` only ever exists complete.
+    """
+    cache_key = audio_cache.key(text, settings["voice"], instructions, TTS_MODEL, audio_format)
+    partial_filename = f"{filename}.part"
+    try:
+        if audio_cache.get(cache_key, partial_filename):
+            CACHE_REQUESTS.labels("audio", "hit").inc()
+            AUDIO_BYTES.labels("cache").inc(os.path.getsize(partial_filename))
+            os.replace(partial_filename, filename)
+            return filename
+        CACHE_REQUESTS.labels("audio", "miss").inc()
+
+        async def download():
+            async with client.audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=settings["voice"],
+                input=text,
+                instructions=instructions,
+                response_format=audio_format
+            ) as response:
+                with open(partial_filename, 'wb') as f:
+                    async for chunk in response.iter_bytes():
+                        f.write(chunk)
+
+        tokens = estimate_tokens(text) + estimate_tokens(instructions)
+        with timed("synthesize_speech"):
+            await tts_scheduler.run(tokens, download)
+        # the speech endpoint does not report usage
+        OPENAI_TOKENS.labels(TTS_MODEL, "estimated_input").inc(tokens)
+        AUDIO_BYTES.labels("api").inc(os.path.getsize(partial_filename))
+        os.replace(partial_filename, filename)
+    finally:
+        # left behind by a failed or cancelled synthesis
+        if os.path.exists(partial_filename):
+            os.remove(partial_filename)
+
+    audio_cache.put(cache_key, filename)
+    return filename
 
-def synthesize_speech(text, instructions, filename, settings):
-    """Converts text to speech using OpenAI TTS and saves as MP3."""
-    response = client.audio.speech.create(
-        model="gpt-4o-mini-tts",
-        voice=settings["voice"],
-        input=text,
-        instructions=instructions
-    )
 
-    with open(filename, 'wb') as f:
-        for chunk in response.iter_bytes():
-            f.write(chunk)
+def deck_key(phrases, settings):
+    """Content hash of an Anki deck, identical for decks built from the same phrases and voice."""
+    rows = [(original, translated, instructions) for original, translated, instructions, _ in phrases]
+    return sha256(json.dumps([rows, settings["voice"], TTS_MODEL, DECK_AUDIO_FORMAT], ensure_ascii=False).encode()).hexdigest()
 
-    return filename
 
+async def send_cached_file(kind, key, send):
+    """Sends a file Telegram already has by the file_id of its earlier upload.
+    Returns False if there is none or it was rejected, and the file has to be uploaded."""
+    file_id = await file_id_cache.get(f"{kind}:{key}")
+    if file_id is not None:
+        try:
+            with timed(f"send_{kind}"):
+                await send(file_id)
+            CACHE_REQUESTS.labels(f"{kind}_file_id", "hit").inc()
+            return True
+        except asyncio_helper.ApiTelegramException as e:
+            logger.warning(f"Cached {kind} file_id was rejected, uploading again: {e}")
+            await file_id_cache.delete(f"{kind}:{key}")
+    CACHE_REQUESTS.labels(f"{kind}_file_id", "miss").inc()
+    return False
 
-def save_settings(chat_dir, settings, **kwargs):
-    for key, value in kwargs.items():
-        settings[key] = value
-    with open(f"{chat_dir}/settings.json", "w") as f:
-        json.dump(settings, f)
 
+async def upload_file(kind, key, filename, send):
+    """Uploads a file and remembers its file_id, so identical content is never uploaded twice.
+    Files that will not be sent again are uploaded with `key` None."""
+    with open(filename, "rb") as f, timed(f"send_{kind}"):
+        sent = await send(f)
+    if key is not None:
+        await file_id_cache.set(f"{kind}:{key}", getattr(sent, kind).file_id)
 
-def get_settings(chat_dir):
-    settings = {"language": DEFAULT_LANGUAGE, "anki": DEFAULT_ANKI, "voice": DEFAULT_VOICE, "gender": voice_to_gender_map[DEFAULT_VOICE]}
-    if not os.path.exists(f"{chat_dir}/settings.json"):
-        with open(f"{chat_dir}/settings.json", "w") as f:
-            json.dump(settings, f)
-    else:
-        with open(f"{chat_dir}/settings.json", "r") as f:
-            settings = {**settings, **json.load(f)}  
-        if settings["language"] not in available_languages:
-            settings["language"] = DEFAULT_LANGUAGE
-        if settings["voice"] not in available_voices:
-            settings["voice"] = DEFAULT_VOICE
-        if settings["gender"] not in available_genders:
-            settings["gender"] = voice_to_gender_map[settings["voice"]]
-        if settings["anki"] not in [True, False]:
-            settings["anki"] = DEFAULT_ANKI
+
+def chat_deck_name(settings):
+    """Name of the deck accumulating a chat's phrases, one per target language."""
+    return f"Эссе::{available_languages[settings['language']].capitalize()}"
+
+
+async def save_settings(chat_id, settings, **kwargs):
+    for key, value in kwargs.items():
+        settings[key] = value
+    await settings_store.update(chat_id, **kwargs)
+
+
+async def get_settings(chat_id):
+    settings = {"language": DEFAULT_LANGUAGE, "anki": DEFAULT_ANKI, "collect": DEFAULT_COLLECT, "voice": DEFAULT_VOICE, "gender": voice_to_gender_map[DEFAULT_VOICE]}
+    settings = {**settings, **(await settings_store.get(chat_id))}
+    if settings["language"] not in available_languages:
+        settings["language"] = DEFAULT_LANGUAGE
+    if settings["voice"] not in available_voices:
+        settings["voice"] = DEFAULT_VOICE
+    if settings["gender"] not in available_genders:
+        settings["gender"] = voice_to_gender_map[settings["voice"]]
+    if settings["anki"] not in [True, False]:
+        settings["anki"] = DEFAULT_ANKI
+    if settings["collect"] not in [True, False] or not COLLECT_AVAILABLE:
+        settings["collect"] = DEFAULT_COLLECT and COLLECT_AVAILABLE
     return settings
 
 
-def handle_webhook(message: dict):
+async def handle_webhook(message: dict):
+    current_chat_id.set(update_chat_id(message) or 0)
     try:
-        bot.process_new_updates([Update.de_json(message)])
+        await bot.process_new_updates([Update.de_json(message)])
     except Exception as e:
-        bot.send_message(message.chat.id, f"Произошла ошибка, попробуйте снова.")
+        chat_id = update_chat_id(message)
+        if chat_id:
+            await bot.send_message(chat_id, f"Произошла ошибка, попробуйте снова.")
         raise e
 
 
-def health_check():
-    user = antiflood(bot.get_me)
+async def health_check():
+    user = await bot.get_me()
     return user is not None
 
 
-def init_bot(webhook_url):
+async def close_bot():
+    await bot.close_session()
+    await client.close()
+
+
+async def init_bot(webhook_url):
     logger.info(f"Setting webhook URL: {webhook_url}")
     set_webhook = partial(bot.set_webhook, url=webhook_url + "/webhook", secret_token=os.getenv("ESSAY2ANKI_SECRET_TOKEN"))
     path_to_ssl_certificate = os.getenv("ESSAY2ANKI_BOT_SSL_CERTIFICATE")
     if path_to_ssl_certificate:
         with open(path_to_ssl_certificate, "rb") as ssl_certificate:
-            set_webhook(certificate=ssl_certificate)
+            await set_webhook(certificate=ssl_certificate)
     else:
-        set_webhook()
-    init_commands()
+        await set_webhook()
+    await init_commands()
+    await warm_up()
 
 
-def init_commands(chat_id: int | None = None):
-    bot.set_chat_menu_button(
+async def warm_up():
+    # build the collection template now rather than in the first Anki request
+    await asyncio.to_thread(collection_template)
+
+
+async def init_commands(chat_id: int | None = None):
+    await bot.set_chat_menu_button(
         chat_id=chat_id,
         menu_button=MenuButtonCommands(type="commands")
     )
-    bot.set_my_commands(
-        commands=[
-            BotCommand(command="start", description="Начать работу с ботом"),
-            BotCommand(command="settings", description="Настройки бота"),
-            BotCommand(command="help", description="Показать доступные команды"),
-        ],
+    commands = [
+        BotCommand(command="start", description="Начать работу с ботом"),
+        BotCommand(command="settings", description="Настройки бота"),
+        BotCommand(command="deck", description="Прислать всю накопленную колоду"),
+        BotCommand(command="help", description="Показать доступные команды"),
+    ]
+    await bot.set_my_commands(
+        commands=[command for command in commands if command.command != "deck" or COLLECT_AVAILABLE],
         scope=BotCommandScopeChat(chat_id=chat_id) if chat_id else None
     )
 
 
-def show_settings(chat_id: int, edit_message_id: int | None = None):
-    chat_dir = get_chat_dir(chat_id)
-    settings = get_settings(chat_dir)
+async def show_settings(chat_id: int, edit_message_id: int | None = None):
+    settings = await get_settings(chat_id)
     sentences = []
     if settings["anki"]:
         sentences.append("*Режим:* Anki")
@@ -220,6 +599,13 @@ def show_settings(chat_id: int, edit_message_id: int | None = None):
     else:
         sentences.append("*Режим:* Чат")
         mode_btn = InlineKeyboardButton(text="Вкл. Anki", callback_data="anki")
+    keyboard = [[mode_btn, InlineKeyboardButton(text="Язык", callback_data="lang"),  InlineKeyboardButton(text="Голос", callback_data="voice")]]
+    if settings["collect"]:
+        sentences.append("*Колода:* накапливается, присылаются только новые фразы")
+        keyboard.append([InlineKeyboardButton(text="Новая колода каждый раз", callback_data="no_collect")])
+    elif COLLECT_AVAILABLE:
+        sentences.append("*Колода:* новая для каждого текста")
+        keyboard.append([InlineKeyboardButton(text="Копить колоду", callback_data="collect")])
     sentences.append(f"*Язык:* {available_languages[settings['language']]}")
     sentences.append(f"*{available_genders[settings['gender']]} голос:* {available_voices[settings['voice']]}")
     text = '\n'.join(sentences)
@@ -227,12 +613,8 @@ def show_settings(chat_id: int, edit_message_id: int | None = None):
         func = partial(bot.edit_message_text, text, chat_id=chat_id, message_id=edit_message_id)
     else:
         func = partial(bot.send_message, chat_id, text)
-    func(
-        reply_markup=InlineKeyboardMarkup(
-            keyboard=[
-                [mode_btn, InlineKeyboardButton(text="Язык", callback_data="lang"),  InlineKeyboardButton(text="Голос", callback_data="voice")]
-            ]
-        ),
+    await func(
+        reply_markup=InlineKeyboardMarkup(keyboard=keyboard),
         parse_mode="Markdown"
     )
 
@@ -246,34 +628,67 @@ def get_chat_dir(chat_id: int):
 
 @bot.message_handler(commands=["start"])
 @handle_error_decorator
-def handle_start(message: Message):
+async def handle_start(message: Message):
+    await settings_store.reset(message.chat.id)
     chat_dir = get_chat_dir(message.chat.id)
     for file in os.listdir(chat_dir):
-        os.remove(f"{chat_dir}/{file}")
-    init_commands(message.chat.id)
-    bot.send_message(message.chat.id, "Отправь мне текст, и я переведу его и озвучу. Ограничение 5000 символов.")
+        path = f"{chat_dir}/{file}"
+        # the accumulated collection keeps its media in a folder
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    await init_commands(message.chat.id)
+    await bot.send_message(message.chat.id, "Отправь мне текст, и я переведу его и озвучу. Ограничение 5000 символов.")
 
 
 @bot.message_handler(commands=["settings"])
 @handle_error_decorator
-def handle_settings(message: Message):
-    show_settings(message.chat.id)
+async def handle_settings(message: Message):
+    await show_settings(message.chat.id)
+
+
+@bot.message_handler(commands=["deck"])
+@handle_error_decorator
+async def handle_deck(message: Message):
+    if not COLLECT_AVAILABLE:
+        await bot.send_message(message.chat.id, "Накопление колоды сейчас недоступно.")
+        return
+    settings = await get_settings(message.chat.id)
+    chat_dir = get_chat_dir(message.chat.id)
+    if not os.path.exists(os.path.join(chat_dir, COLLECTION_FILENAME)):
+        await bot.send_message(message.chat.id, "Колода пока пуста. Включите накопление колоды в /settings.")
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        anki_package_filename = os.path.join(tmpdir, "deck.apkg")
+        deck = await asyncio.to_thread(ChatDeck, chat_dir, chat_deck_name(settings))
+        try:
+            if len(deck):
+                with timed("export_anki_package"):
+                    await asyncio.to_thread(deck.export_all, anki_package_filename)
+                PACKAGE_BYTES.observe(os.path.getsize(anki_package_filename))
+        finally:
+            await asyncio.to_thread(deck.close)
+        if not os.path.exists(anki_package_filename):
+            await bot.send_message(message.chat.id, "Колода пока пуста.")
+            return
+        await bot.send_chat_action(message.chat.id, "upload_document")
+        await upload_file("document", None, anki_package_filename, partial(bot.send_document, message.chat.id))
 
 
 @bot.callback_query_handler(func=lambda call: call.data in available_voices)
 @handle_error_decorator
-def handle_voice_callback(call: CallbackQuery):
-    chat_dir = get_chat_dir(call.message.chat.id)
-    settings = get_settings(chat_dir)
-    save_settings(chat_dir, settings, voice=call.data, gender=voice_to_gender_map[call.data])
-    show_settings(call.message.chat.id, call.message.id)
+async def handle_voice_callback(call: CallbackQuery):
+    settings = await get_settings(call.message.chat.id)
+    await save_settings(call.message.chat.id, settings, voice=call.data, gender=voice_to_gender_map[call.data])
+    await show_settings(call.message.chat.id, call.message.id)
 
 
 @bot.callback_query_handler(func=lambda call: call.data in available_genders)
 @handle_error_decorator
-def handle_gender_callback(call: CallbackQuery):
+async def handle_gender_callback(call: CallbackQuery):
     voices = gender_to_voices_map[call.data]
-    bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text="Выберите голос",
+    await bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text="Выберите голос",
                               reply_markup=InlineKeyboardMarkup(
                                 keyboard=[
                                     [InlineKeyboardButton(text=available_voices[voice], callback_data=voice) for voice in voices],
@@ -285,23 +700,27 @@ def handle_gender_callback(call: CallbackQuery):
 
 @bot.callback_query_handler(func=lambda call: call.data in ["back_to_settings"])
 @handle_error_decorator
-def handle_back_to_settings_callback(call: CallbackQuery):
-    show_settings(call.message.chat.id, call.message.id)
+async def handle_back_to_settings_callback(call: CallbackQuery):
+    await show_settings(call.message.chat.id, call.message.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data in ["anki", "chat", "lang", "voice"])
+@bot.callback_query_handler(func=lambda call: call.data in ["anki", "chat", "collect", "no_collect", "lang", "voice"])
 @handle_error_decorator
-def handle_settings_callback(call: CallbackQuery):
-    chat_dir = get_chat_dir(call.message.chat.id)
-    settings = get_settings(chat_dir)
+async def handle_settings_callback(call: CallbackQuery):
+    settings = await get_settings(call.message.chat.id)
     if call.data == "anki":
-        save_settings(chat_dir, settings, anki=True)
-        show_settings(call.message.chat.id, call.message.id)
+        await save_settings(call.message.chat.id, settings, anki=True)
+        await show_settings(call.message.chat.id, call.message.id)
     elif call.data == "chat":
-        save_settings(chat_dir, settings, anki=False)
-        show_settings(call.message.chat.id, call.message.id)
+        await save_settings(call.message.chat.id, settings, anki=False)
+        await show_settings(call.message.chat.id, call.message.id)
+    elif call.data in ("collect", "no_collect"):
+        # a button of an older settings message may offer it while it is unavailable
+        if COLLECT_AVAILABLE:
+            await save_settings(call.message.chat.id, settings, collect=call.data == "collect")
+        await show_settings(call.message.chat.id, call.message.id)
     elif call.data == "lang":
-        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=f"Выберите язык перевода",
+        await bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=f"Выберите язык перевода",
                               reply_markup=InlineKeyboardMarkup(
                                 keyboard=[
                                     [InlineKeyboardButton(text=language_flag_emojis[language], callback_data=language) for language in available_languages.keys()],
@@ -309,7 +728,7 @@ def handle_settings_callback(call: CallbackQuery):
                                 ]
                               ))
     elif call.data == "voice":
-        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=f"Выберите пол",
+        await bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=f"Выберите пол",
                               reply_markup=InlineKeyboardMarkup(
                                 keyboard=[
                                     [InlineKeyboardButton(text=gender_name, callback_data=gender) for gender, gender_name in available_genders.items()],
@@ -319,110 +738,161 @@ def handle_settings_callback(call: CallbackQuery):
 
 @bot.callback_query_handler(func=lambda call: call.data in available_languages)
 @handle_error_decorator
-def handle_lang_callback(call: CallbackQuery):
-    chat_dir = get_chat_dir(call.message.chat.id)
-    settings = get_settings(chat_dir)
-    save_settings(chat_dir, settings, language=call.data)
-    show_settings(call.message.chat.id, call.message.id)
+async def handle_lang_callback(call: CallbackQuery):
+    settings = await get_settings(call.message.chat.id)
+    await save_settings(call.message.chat.id, settings, language=call.data)
+    await show_settings(call.message.chat.id, call.message.id)
 
 
 @bot.message_handler(commands=["help"])
 @handle_error_decorator
-def handle_help(message: Message):
-    commands = bot.get_my_commands()
+async def handle_help(message: Message):
+    commands = await bot.get_my_commands()
     sentences = [
         "Отправь мне текст, и я переведу его и озвучу. Ограничение 1000 символов.",
         "Доступные команды:",
         *[f"/{command.command} - {command.description}" for command in commands]
     ]
-    bot.send_message(message.chat.id, '\n'.join(sentences))
+    await bot.send_message(message.chat.id, '\n'.join(sentences))
 
 
 @bot.message_handler()
 @handle_error_decorator
-def handle_message(message: Message):
+async def handle_message(message: Message):
+    with timed("handle_message"):
+        await translate_message(message)
+
+
+async def translate_message(message: Message):
     if message.text.startswith("/"):
-        handle_help(message)
+        await handle_help(message)
         return
     if len(message.text) > 5000:
-        bot.send_message(message.chat.id, "Текст слишком длинный, попробуй меньше 5000 символов.")
+        await bot.send_message(message.chat.id, "Текст слишком длинный, попробуй меньше 5000 символов.")
         return
 
-    chat_dir = get_chat_dir(message.chat.id)
-    settings = get_settings(chat_dir)
+    settings = await get_settings(message.chat.id)
 
     with tempfile.TemporaryDirectory() as tmpdir:
-        bot.send_chat_action(message.chat.id, "typing")
-        translated_text = translate_text(message.text, settings)
-        if len(translated_text) > 7000:
-            bot.send_message("Получился слишком длинный текст, попробуйте снова.", message.chat.id)
-            return
+        await bot.send_chat_action(message.chat.id, "typing")
         if not settings["anki"]:
-            # strip instructions from translated text in brackets
-            instructions = re.search(r'\((.*?)\)', translated_text)
-            if instructions:
-                instructions = instructions.group(1)
-                translated_text = re.sub(r'\((.*?)\)', '', translated_text)
-            else:
-                instructions = DEFAULT_INSTRUCTIONS    
-            bot.send_message(message.chat.id, translated_text, reply_parameters=ReplyParameters(message.id, allow_sending_without_reply=True))
-            bot.send_chat_action(message.chat.id, "record_voice")
-            audio_filename = os.path.join(tmpdir, f"audio_{sha256(translated_text.encode()).hexdigest()}.mp3")
-            synthesize_speech(translated_text, instructions, audio_filename, settings)
-            with open(audio_filename, "rb") as audio:
-                bot.send_voice(message.chat.id, audio,
-                    reply_parameters=ReplyParameters(message.id, allow_sending_without_reply=True))
-            return
-        
-        lines = translated_text.strip().split("\n")
-        lines = [line for line in lines if ';' in line]
-
-        if not lines:
-            bot.send_message("Не получилось перевести текст, попробуйте снова.", message.chat.id)
+            reply = ProgressiveReply(message)
+            translated_text = ""
+            instructions = ""
+            try:
+                async for delta in stream_speech_translation(message.text, settings):
+                    instructions = instructions or delta.instructions
+                    translated_text += delta.text
+                    await reply.update(translated_text)
+            except TranslationTooLong:
+                await forget_translation(message.text, settings)
+                await bot.send_message(message.chat.id, "Получился слишком длинный текст, попробуйте снова.")
+                return
+            translated_text = translated_text.strip()
+            if not translated_text:
+                await bot.send_message(message.chat.id, "Не получилось перевести текст, попробуйте снова.")
+                return
+            instructions = instructions or DEFAULT_INSTRUCTIONS
+            await reply.flush()
+            send_voice = partial(bot.send_voice, message.chat.id,
+                reply_parameters=ReplyParameters(message.id, allow_sending_without_reply=True))
+            # the same text, voice and instructions always make the same voice message
+            voice_key = audio_cache.key(translated_text, settings["voice"], instructions, TTS_MODEL, VOICE_AUDIO_FORMAT)
+            if await send_cached_file("voice", voice_key, send_voice):
+                return
+            await bot.send_chat_action(message.chat.id, "record_voice")
+            audio_filename = os.path.join(tmpdir, f"audio_{sha256(translated_text.encode()).hexdigest()}.{AUDIO_EXTENSIONS[VOICE_AUDIO_FORMAT]}")
+            await synthesize_speech(translated_text, instructions, audio_filename, settings, VOICE_AUDIO_FORMAT)
+            await upload_file("voice", voice_key, audio_filename, send_voice)
             return
 
-        translated_text = '\n'.join([f"*{line.split(';')[0]}* | {line.split(';')[1]}" for line in lines])
-        bot.send_message(message.chat.id, translated_text,
-            reply_parameters=ReplyParameters(message.id, allow_sending_without_reply=True),
-            parse_mode="Markdown")
-
-        deck_name = lines[0].split(";")[0].strip()
+        reply = ProgressiveReply(message, parse_mode="Markdown")
         anki_package_filename = os.path.join(tmpdir, "deck.apkg")
-        collection = Collection(os.path.join(tmpdir, "collection.anki2"))
+        send_document = partial(bot.send_document, message.chat.id,
+            reply_parameters=ReplyParameters(message.id, allow_sending_without_reply=True))
+        phrases = []
+        # audio of the deck by filename, phrases that sound the same are synthesized once
+        media = {}
+        # the collection is set up in a thread while the model is translating
+        if settings["collect"]:
+            # notes accumulate in the chat's own collection and only the new ones are sent
+            opening_deck = asyncio.create_task(asyncio.to_thread(ChatDeck, get_chat_dir(message.chat.id), chat_deck_name(settings)))
+        else:
+            opening_deck = asyncio.create_task(asyncio.to_thread(DeckBuilder, tmpdir))
         try:
-            deck_id = collection.decks.add_normal_deck_with_name(deck_name).id
-            collection.decks.set_current(deck_id)
-            add_note_requests = []
-            for i in range(0, len(lines)):
-                bot.send_chat_action(message.chat.id, "upload_document")
-                original = lines[i].split(";")[0].strip()
-                translated = lines[i].split(";")[1].strip()
-                instructions = lines[i].split(";")[2].strip()
-                mp3_filename = f"phrase_{len(add_note_requests)+1}_{sha256(translated.encode()).hexdigest()}.mp3"
-                mp3_filename_path = os.path.join(tmpdir, mp3_filename)
-
-                synthesize_speech(translated, instructions, mp3_filename_path, settings)
-                mp3_filename = collection.media.add_file(mp3_filename_path)
-                note = collection.new_note(collection.models.by_name("Basic"))
-                note.fields = [original, f"{translated}[sound:{mp3_filename}]"]
-                note.tags = ["эссе"]
-                add_note_requests.append(AddNoteRequest(note=note, deck_id=deck_id))
-            
-            collection.add_notes(add_note_requests)
-            collection.export_anki_package(
-                out_path=anki_package_filename,
-                options=ExportAnkiPackageOptions(
-                    with_media=True,
-                    legacy=True
-                ),
-                limit=DeckIdLimit(
-                    deck_id=deck_id
-                )
-            )
+            deck = None
+            async for original, translated, instructions in stream_phrases(message.text, settings):
+                instructions = instructions or DEFAULT_INSTRUCTIONS
+                deck = deck or await opening_deck
+                if settings["collect"] and deck.has(original):
+                    # the user already has this phrase and its audio
+                    phrases.append((original, translated, instructions, None))
+                    await reply.update('\n'.join([f"*{original}* | {translated}" for original, translated, _, _ in phrases]))
+                    continue
+                # audio is named by what it sounds like, so notes with the same audio share one file
+                # and a note never overwrites the audio of another
+                audio_key = audio_cache.key(translated, settings["voice"], instructions, TTS_MODEL, DECK_AUDIO_FORMAT)
+                audio_filename = f"{audio_key}.{AUDIO_EXTENSIONS[DECK_AUDIO_FORMAT]}"
+                audio = media.get(audio_filename)
+                if audio is None:
+                    audio_path = deck.media_path(audio_filename)
+                    if os.path.exists(audio_path):
+                        # an earlier note of the chat's deck has this audio already
+                        audio = asyncio.get_running_loop().create_future()
+                        audio.set_result(audio_path)
+                    else:
+                        # start synthesis right away, while the model is still writing the next phrases,
+                        # the audio lands directly in the collection media folder
+                        audio = speech_pool.submit(message.chat.id, synthesize_speech, translated, instructions,
+                                                   audio_path, settings, DECK_AUDIO_FORMAT)
+                    media[audio_filename] = audio
+                with timed("add_note"):
+                    deck.add_note(original, f"{translated}[sound:{audio_filename}]", ["эссе"])
+                phrases.append((original, translated, instructions, audio))
+                await reply.update('\n'.join([f"*{original}* | {translated}" for original, translated, _, _ in phrases]))
+            await reply.flush()
+
+            if not phrases:
+                await forget_translation(message.text, settings)
+                await bot.send_message(message.chat.id, "Не получилось перевести текст, попробуйте снова.")
+                return
+
+            audios = [audio for _, _, _, audio in phrases if audio is not None]
+            if not audios:
+                await bot.send_message(message.chat.id, "Все фразы уже есть в вашей колоде, /deck пришлёт её целиком.")
+                return
+
+            # a deck of the same phrases was sent before, no need to wait for the audio and export it again,
+            # accumulated decks depend on what the chat had before and are not sent twice
+            key = None if settings["collect"] else deck_key(phrases, settings)
+            if key and await send_cached_file("document", key, send_document):
+                return
+            await bot.send_chat_action(message.chat.id, "upload_document")
+            await asyncio.gather(*audios)
+            with timed("export_anki_package"):
+                await asyncio.to_thread(deck.export, anki_package_filename)
+            package_size = os.path.getsize(anki_package_filename)
+            PACKAGE_BYTES.observe(package_size)
+            logger.info(f"Exported deck of {len(audios)} notes with {DECK_AUDIO_FORMAT} audio, {package_size} bytes")
+
+            await bot.send_chat_action(message.chat.id, "upload_document")
+            await upload_file("document", key, anki_package_filename, send_document)
+            if settings["collect"]:
+                # the notes stay in the chat's deck only once the user has them
+                deck.commit()
+        except TranslationTooLong:
+            await forget_translation(message.text, settings)
+            await bot.send_message(message.chat.id, "Получился слишком длинный текст, попробуйте снова.")
+            return
+        except TranslationIncomplete:
+            # the deck is not sent without the phrases that are missing
+            await bot.send_message(message.chat.id, "Не получилось перевести часть текста, попробуйте снова.")
+            return
         finally:
-            collection.close()
-
-        bot.send_chat_action(message.chat.id, "upload_document")
-        with open(anki_package_filename, "rb") as zipf:
-            bot.send_document(message.chat.id, zipf,  
-                            reply_parameters=ReplyParameters(message.id, allow_sending_without_reply=True))
+            synthesis = [audio for _, _, _, audio in phrases if audio is not None]
+            for audio in synthesis:
+                audio.cancel()
+            # a cancellation can be lost inside the HTTP client, the audio must not be written after the deck
+            # cleaned up its media or the temporary directory is gone
+            await asyncio.gather(*synthesis, return_exceptions=True)
+            await asyncio.to_thread((await opening_deck).close)
@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from redis_client import redis_client, REDIS_PREFIX
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = os.getenv("ESSAY2ANKI_CACHE_BACKEND", "memory")
+CACHE_SQLITE_PATH = os.getenv("ESSAY2ANKI_CACHE_SQLITE_PATH", "cache/cache.sqlite3")
+
+
+class MemoryCache:
+    """In-process key-value cache with per-entry TTL and LRU capacity limit."""
+
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: str):
+        with self._lock:
+            self._set(key, value)
+
+    async def add(self, key: str, value: str) -> bool:
+        """Sets the key only if it has no live entry, returns whether it did."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return False
+            self._set(key, value)
+            return True
+
+    def _set(self, key: str, value: str):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, value)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SqliteCache:
+    """Key-value cache persisted in a SQLite file, shared by all caches of the process.
+
+    Queries run in a thread, so the event loop does not wait for the disk.
+    Expired and least recently used entries are pruned every `capacity // 100`
+    writes rather than on each one, so a namespace may briefly hold up to 1%
+    more entries than `capacity`. The access time of an entry is refreshed at
+    most once every `ACCESS_RESOLUTION` seconds, to spare a write per hit.
+    """
+
+    ACCESS_RESOLUTION = 60
+
+    def __init__(self, path: str, namespace: str, ttl: float, capacity: int):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._prune_every = max(1, capacity // 100)
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (namespace, accessed_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (namespace, expires_at)")
+
+    async def get(self, key: str) -> str | None:
+        return await asyncio.to_thread(self._get, key)
+
+    def _get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at, accessed_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._db.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+                return None
+            if now - row[2] > self.ACCESS_RESOLUTION:
+                self._db.execute(
+                    "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    (now, self.namespace, key)
+                )
+            return row[0]
+
+    async def set(self, key: str, value: str):
+        await asyncio.to_thread(self._set, key, value)
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, value, now + self.ttl, now)
+            )
+            self._written(now)
+
+    def _written(self, now: float):
+        """Counts a write and prunes the namespace every `_prune_every` of them. Called with the lock held."""
+        self._writes += 1
+        if self._writes < self._prune_every:
+            return
+        self._writes = 0
+        self._db.execute("DELETE FROM cache WHERE namespace = ? AND expires_at < ?", (self.namespace, now))
+        # both walk the accessed_at index, only the entries past the capacity are visited
+        self._db.execute(
+            "DELETE FROM cache WHERE namespace = ? AND accessed_at <= ("
+            "SELECT accessed_at FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT 1 OFFSET ?)",
+            (self.namespace, self.namespace, self.capacity)
+        )
+
+    async def add(self, key: str, value: str) -> bool:
+        """Sets the key only if it has no live entry, returns whether it did."""
+        return await asyncio.to_thread(self._add, key, value)
+
+    def _add(self, key: str, value: str) -> bool:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ? AND expires_at < ?",
+                (self.namespace, key, now)
+            )
+            inserted = self._db.execute(
+                "INSERT OR IGNORE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, value, now + self.ttl, now)
+            ).rowcount
+            if inserted:
+                self._written(now)
+        return inserted > 0
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._delete, key)
+
+    def _delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+
+class RedisCache:
+    """Key-value cache in Redis, shared by all instances of the bot.
+
+    Entries expire after `ttl`, the capacity is left to the server's eviction policy.
+    """
+
+    def __init__(self, client, namespace: str, ttl: float):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._redis = client
+        self._prefix = f"{REDIS_PREFIX}cache:{namespace}:"
+
+    async def get(self, key: str) -> str | None:
+        return await self._redis.get(self._prefix + key)
+
+    async def set(self, key: str, value: str):
+        await self._redis.set(self._prefix + key, value, px=int(self.ttl * 1000))
+
+    async def add(self, key: str, value: str) -> bool:
+        """Sets the key only if it has no live entry, returns whether it did. Atomic across instances."""
+        return bool(await self._redis.set(self._prefix + key, value, px=int(self.ttl * 1000), nx=True))
+
+    async def delete(self, key: str):
+        await self._redis.delete(self._prefix + key)
+
+
+def create_cache(namespace: str, ttl: float, capacity: int, backend: str = CACHE_BACKEND):
+    """Cache of the given backend. The methods of every backend are coroutines, as Redis is a network round trip."""
+    logger.info(f"Using {backend} backend for {namespace} cache")
+    if backend == "memory":
+        return MemoryCache(ttl, capacity)
+    if backend == "sqlite":
+        return SqliteCache(CACHE_SQLITE_PATH, namespace, ttl, capacity)
+    if backend == "redis":
+        return RedisCache(redis_client(), namespace, ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
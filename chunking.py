@@ -0,0 +1,37 @@
+import re
+
+PARAGRAPH_SEPARATOR = re.compile(r"\n\s*\n")
+SENTENCE_SEPARATOR = re.compile(r"(?<=[.!?…])\s+")
+
+
+def _pack(parts: list[str], separator: str, max_chars: int) -> list[str]:
+    chunks = []
+    current = ""
+    for part in parts:
+        if current and len(current) + len(separator) + len(part) > max_chars:
+            chunks.append(current)
+            current = part
+        else:
+            current = f"{current}{separator}{part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_text(text: str, max_chars: int) -> list[str]:
+    """Splits text into chunks of at most `max_chars` characters on paragraph boundaries,
+    falling back to sentence boundaries for paragraphs that are too long on their own.
+    A single sentence longer than `max_chars` is kept whole."""
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text]
+    parts = []
+    for paragraph in PARAGRAPH_SEPARATOR.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            parts.append(paragraph)
+        else:
+            parts.extend(_pack(SENTENCE_SEPARATOR.split(paragraph), " ", max_chars))
+    return _pack(parts, "\n\n", max_chars)
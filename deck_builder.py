@@ -0,0 +1,143 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+
+from anki.collection import Collection, ExportAnkiPackageOptions, DeckIdLimit, NoteIdsLimit
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_FILENAME = "collection.anki2"
+
+_template_lock = threading.Lock()
+_template_dir: tempfile.TemporaryDirectory | None = None
+
+
+def collection_template() -> str:
+    """Path of an empty collection, created once per process and copied for every deck.
+
+    Creating a collection initializes its schema, note types and config, copying
+    the file of one that already has them is several times cheaper.
+    """
+    global _template_dir
+    with _template_lock:
+        if _template_dir is None:
+            template_dir = tempfile.TemporaryDirectory(prefix="essay2anki-template-")
+            Collection(os.path.join(template_dir.name, COLLECTION_FILENAME)).close()
+            _template_dir = template_dir
+            logger.info(f"Created collection template in {template_dir.name}")
+        return os.path.join(_template_dir.name, COLLECTION_FILENAME)
+
+
+class DeckBuilder:
+    """Builds a single-deck Anki package in a throwaway collection.
+
+    The collection is opened up front, so its setup overlaps with translation.
+    Notes are added as soon as their phrase is known and may reference audio
+    that is still being written straight into the media folder by `media_path`;
+    the audio only has to be complete by the time `export` is called.
+    """
+
+    def __init__(self, directory: str):
+        path = os.path.join(directory, COLLECTION_FILENAME)
+        if not os.path.exists(path):
+            shutil.copyfile(collection_template(), path)
+        self.collection = Collection(path)
+        self.deck_id = None
+        self._model = self.collection.models.by_name("Basic")
+        self._media_dir = self.collection.media.dir()
+
+    def media_path(self, filename: str) -> str:
+        return os.path.join(self._media_dir, filename)
+
+    def add_note(self, front: str, back: str, tags: list[str]) -> int:
+        if self.deck_id is None:
+            # the deck is named after the first phrase
+            self.deck_id = self.collection.decks.add_normal_deck_with_name(front).id
+            self.collection.decks.set_current(self.deck_id)
+        note = self.collection.new_note(self._model)
+        note.fields = [front, back]
+        note.tags = tags
+        self.collection.add_note(note, self.deck_id)
+        return note.id
+
+    def export(self, out_path: str):
+        self._export(out_path, DeckIdLimit(deck_id=self.deck_id))
+
+    def _export(self, out_path: str, limit):
+        self.collection.export_anki_package(
+            out_path=out_path,
+            options=ExportAnkiPackageOptions(
+                with_media=True,
+                legacy=True
+            ),
+            limit=limit
+        )
+
+    def close(self):
+        self.collection.close()
+
+
+class ChatDeck(DeckBuilder):
+    """Deck of one chat that accumulates notes across essays in a persistent collection.
+
+    A phrase already in the deck is not added again and `export` packages only
+    the notes added since the deck was opened. Unless they are kept by `commit`
+    once the package has reached the user, `close` removes them again together
+    with the audio written for them, so a failed request leaves neither notes
+    without audio, audio without notes, nor notes the user never received.
+    """
+
+    def __init__(self, directory: str, deck_name: str):
+        super().__init__(directory)
+        self.deck_id = self.collection.decks.id(deck_name)
+        self.added: list[int] = []
+        self._committed = False
+        # audio files this deck created, an existing file may belong to an earlier note
+        self._media: list[str] = []
+        self._fronts = {
+            fields.split("\x1f", 1)[0]
+            for fields in self.collection.db.list(
+                "SELECT flds FROM notes WHERE id IN (SELECT nid FROM cards WHERE did = ?)", self.deck_id
+            )
+        }
+
+    def __len__(self) -> int:
+        return len(self._fronts)
+
+    def has(self, front: str) -> bool:
+        return front in self._fronts
+
+    def media_path(self, filename: str) -> str:
+        path = super().media_path(filename)
+        if not os.path.exists(path):
+            self._media.append(path)
+        return path
+
+    def add_note(self, front: str, back: str, tags: list[str]) -> int:
+        note_id = super().add_note(front, back, tags)
+        self._fronts.add(front)
+        self.added.append(note_id)
+        return note_id
+
+    def export(self, out_path: str):
+        self._export(out_path, NoteIdsLimit(note_ids=self.added))
+
+    def commit(self):
+        """Keeps the notes added since the deck was opened when it is closed."""
+        self._committed = True
+
+    def export_all(self, out_path: str):
+        super().export(out_path)
+
+    def close(self):
+        if not self._committed:
+            if self.added:
+                self.collection.remove_notes(self.added)
+            for path in self._media:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        super().close()
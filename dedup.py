@@ -0,0 +1,39 @@
+import os
+import logging
+
+from cache import create_cache, CACHE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+DEDUP_BACKEND = os.getenv("ESSAY2ANKI_DEDUP_BACKEND", CACHE_BACKEND)
+DEDUP_TTL = float(os.getenv("ESSAY2ANKI_DEDUP_TTL", str(24 * 60 * 60)))
+DEDUP_CAPACITY = int(os.getenv("ESSAY2ANKI_DEDUP_CAPACITY", "10000"))
+
+
+class UpdateDeduplicator:
+    """Remembers recently accepted `update_id`s so redelivered Telegram updates are processed only once."""
+
+    def __init__(self, seen):
+        self._seen = seen
+        self.suppressed = 0
+
+    async def is_duplicate(self, update: dict) -> bool:
+        """Records the update as seen, returns True if it was already seen before."""
+        update_id = update.get("update_id")
+        if update_id is None:
+            return False
+        # a single atomic check-and-set, so that of several instances receiving the update only one accepts it
+        if not await self._seen.add(str(update_id), "1"):
+            self.suppressed += 1
+            logger.info(f"Suppressed duplicate update {update_id} ({self.suppressed} total)")
+            return True
+        return False
+
+    async def forget(self, update: dict):
+        """Un-records an update that was not accepted, so its redelivery is processed."""
+        update_id = update.get("update_id")
+        if update_id is not None:
+            await self._seen.delete(str(update_id))
+
+
+update_deduplicator = UpdateDeduplicator(create_cache("updates", DEDUP_TTL, DEDUP_CAPACITY, DEDUP_BACKEND))
@@ -0,0 +1,33 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, start_http_server, CONTENT_TYPE_LATEST
+
+STAGE_SECONDS = Histogram(
+    "essay2anki_stage_seconds", "Duration of request processing stages", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+OPENAI_TOKENS = Counter("essay2anki_openai_tokens_total", "Tokens used by OpenAI calls", ["model", "kind"])
+PACKAGE_BYTES = Histogram(
+    "essay2anki_package_bytes", "Size of exported Anki packages",
+    buckets=(64 << 10, 256 << 10, 1 << 20, 2 << 20, 5 << 20, 10 << 20, 20 << 20, 50 << 20)
+)
+AUDIO_BYTES = Counter("essay2anki_audio_bytes_total", "Bytes of synthesized audio", ["source"])
+CACHE_REQUESTS = Counter("essay2anki_cache_requests_total", "Cache lookups", ["cache", "result"])
+SUPPRESSED_UPDATES = Counter("essay2anki_suppressed_updates_total", "Redelivered updates that were dropped")
+REJECTED_UPDATES = Counter("essay2anki_rejected_updates_total", "Updates rejected because the queue was full")
+UPDATE_QUEUE_SIZE = Gauge("essay2anki_update_queue_size", "Updates waiting or being processed")
+SCHEDULER_QUEUED = Gauge("essay2anki_scheduler_queued", "OpenAI calls waiting for rate limit budget", ["model"])
+AUDIO_CACHE_BYTES = Gauge("essay2anki_audio_cache_bytes", "Size of the audio cache on disk")
+AUDIO_CACHE_ENTRIES = Gauge("essay2anki_audio_cache_entries", "Number of files in the audio cache")
+
+
+def timed(stage: str):
+    """Context manager recording the duration of its body as `stage`."""
+    return STAGE_SECONDS.labels(stage).time()
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def serve(port: int):
+    """Exposes the metrics of a process without its own web server, such as a worker."""
+    start_http_server(port)
@@ -0,0 +1,169 @@
+import re
+import json
+from typing import NamedTuple
+
+
+class Phrase(NamedTuple):
+    """One row of an Anki-mode translation."""
+    original: str
+    translated: str
+    instructions: str
+
+    @classmethod
+    def from_json(cls, value) -> "Phrase":
+        """Builds a phrase from a decoded JSON object, missing or mistyped fields are left empty."""
+        if not isinstance(value, dict):
+            value = {}
+        return cls(*[
+            field.strip() if isinstance(field := value.get(name), str) else ""
+            for name in cls._fields
+        ])
+
+    @property
+    def valid(self) -> bool:
+        return bool(self.original and self.translated)
+
+
+class TranslationDelta(NamedTuple):
+    """Piece of a chat-mode translation, with the tts instructions for the whole translation."""
+    instructions: str
+    text: str
+
+
+def _json_schema(name: str, properties: dict) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+PHRASES_FORMAT = _json_schema("phrases", {
+    "phrases": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {name: {"type": "string"} for name in Phrase._fields},
+            "required": list(Phrase._fields),
+            "additionalProperties": False,
+        },
+    },
+})
+# the instructions come first, so the translation can be shown while it is still being written
+SPEECH_FORMAT = _json_schema("speech", {
+    "instructions": {"type": "string"},
+    "translation": {"type": "string"},
+})
+
+_PHRASES_START = re.compile(r'"phrases"\s*:\s*\[')
+_ELEMENT_SEPARATOR = re.compile(r"[\s,]*")
+# string contents up to an unfinished escape sequence or the closing quote
+_STRING_CONTENTS = re.compile(r'(?:[^"\\]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*')
+
+
+class PhraseParser:
+    """Incremental parser of a streamed `PHRASES_FORMAT` answer.
+
+    Each element of the phrases array is decoded once, as soon as its closing
+    brace has arrived, so phrases are available while the model is still
+    writing the next ones.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self._buffer = ""
+        self._position = None
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, delta: str) -> list[Phrase]:
+        self._buffer += delta
+        # an element can only have been completed by a closing brace
+        if self._position is not None and "}" not in delta:
+            return []
+        return self._parse()
+
+    def close(self) -> list[Phrase]:
+        """Parses whatever is left at the end of the answer, `complete` tells if the array was closed."""
+        return self._parse()
+
+    def _parse(self) -> list[Phrase]:
+        if self.complete:
+            return []
+        if self._position is None:
+            start = _PHRASES_START.search(self._buffer)
+            if start is None:
+                return []
+            self._position = start.end()
+        phrases = []
+        while True:
+            position = _ELEMENT_SEPARATOR.match(self._buffer, self._position).end()
+            if position == len(self._buffer):
+                break
+            if self._buffer[position] == "]":
+                self.complete = True
+                break
+            try:
+                value, self._position = self._decoder.raw_decode(self._buffer, position)
+            except json.JSONDecodeError:
+                # unfinished, or malformed and left for `complete` to report
+                break
+            phrases.append(Phrase.from_json(value))
+        return phrases
+
+
+class SpeechParser:
+    """Incremental parser of a streamed `SPEECH_FORMAT` answer, decodes the translation as it is written."""
+
+    def __init__(self):
+        self.instructions = ""
+        self.translation = ""
+        self._buffer = ""
+        self._position = None
+
+    def feed(self, delta: str) -> str:
+        """Returns the part of the translation that `delta` completed."""
+        self._buffer += delta
+        if self._position is None:
+            # the schema puts the instructions before the translation
+            self.instructions = self._string_value("instructions") or ""
+            start = re.search(r'"translation"\s*:\s*"', self._buffer)
+            if start is None:
+                return ""
+            self._position = start.end()
+        end = _STRING_CONTENTS.match(self._buffer, self._position).end()
+        piece = json.loads(f'"{self._buffer[self._position:end]}"')
+        # a surrogate pair is decoded together with its second half
+        if piece and "\ud800" <= piece[-1] <= "\udbff":
+            piece = piece[:-1]
+            end -= 6
+        self._position = end
+        self.translation += piece
+        return piece
+
+    def _string_value(self, name: str) -> str | None:
+        match = re.search(rf'"{name}"\s*:\s*("{_STRING_CONTENTS.pattern}")', self._buffer)
+        return json.loads(match.group(1)).strip() if match else None
+
+
+def untranslated_tail(text: str, originals: list[str]) -> str | None:
+    """Part of `text` after the last of the `originals` the model got to.
+
+    None if the last original cannot be found in the text, as then there is
+    no telling where the model stopped.
+    """
+    position = 0
+    for i, original in enumerate(originals):
+        found = text.find(original, position)
+        if found >= 0:
+            position = found + len(original)
+        elif i == len(originals) - 1:
+            return None
+    return text[position:].strip() if originals else text.strip()
@@ -0,0 +1,218 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextvars import ContextVar
+
+import openai
+
+from redis_client import redis_client, REDIS_PREFIX
+from update_queue import QUEUE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+CHAT_RPM = int(os.getenv("ESSAY2ANKI_CHAT_RPM", "500"))
+CHAT_TPM = int(os.getenv("ESSAY2ANKI_CHAT_TPM", "30000"))
+TTS_RPM = int(os.getenv("ESSAY2ANKI_TTS_RPM", "500"))
+TTS_TPM = int(os.getenv("ESSAY2ANKI_TTS_TPM", "50000"))
+RATE_LIMIT_RETRIES = int(os.getenv("ESSAY2ANKI_RATE_LIMIT_RETRIES", "5"))
+RATE_LIMIT_BACKOFF = float(os.getenv("ESSAY2ANKI_RATE_LIMIT_BACKOFF", "1.0"))
+# with a shared queue several processes call OpenAI, and the budget of the API key has to be shared between them
+RATE_LIMIT_BACKEND = os.getenv("ESSAY2ANKI_RATE_LIMIT_BACKEND", "redis" if QUEUE_BACKEND == "redis" else "local")
+
+# chat on whose behalf OpenAI is called, set once per update so every call made while handling it is attributed
+current_chat_id: ContextVar[int] = ContextVar("current_chat_id", default=0)
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, errs on the high side for Cyrillic and Greek text."""
+    return len(text) // 2 + 1
+
+
+def retry_after(e: Exception) -> float | None:
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(response.headers[header]) * scale
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+class TokenBucket:
+    """Requests-per-minute and tokens-per-minute budget of one model."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def try_acquire(self, tokens: int) -> float:
+        """Takes one request and `tokens` tokens from the budget, or returns how many seconds to wait for them."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        # a single request bigger than the whole budget is let through once the bucket is full
+        tokens = min(tokens, self.tpm)
+        if self._requests >= 1 and self._tokens >= tokens:
+            self._requests -= 1
+            self._tokens -= tokens
+            return 0
+        return max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm, 0.01)
+
+    async def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RedisBudget:
+    """Requests-per-minute and tokens-per-minute budget of one model, shared by all processes through Redis.
+
+    Usage is counted in one-minute windows. The previous window counts with
+    the part of it that is still within the last minute, which approximates a
+    sliding window with plain counters. A call takes its share up front and
+    gives it back if that went over the budget, so concurrent callers can only
+    err on the side of waiting.
+    """
+
+    def __init__(self, client, name: str, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._redis = client
+        self._prefix = f"{REDIS_PREFIX}ratelimit:{name}"
+
+    def _keys(self, window: int) -> tuple[str, str]:
+        return f"{self._prefix}:{window}:requests", f"{self._prefix}:{window}:tokens"
+
+    async def try_acquire(self, tokens: int) -> float:
+        """Takes one request and `tokens` tokens from the budget, or returns how many seconds to wait for them."""
+        # a single request bigger than the whole budget is let through once the last minute is empty
+        tokens = min(tokens, self.tpm)
+        window, elapsed = divmod(time.time(), 60)
+        requests_key, tokens_key = self._keys(int(window))
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.pttl(f"{self._prefix}:paused")
+                pipe.mget(*self._keys(int(window) - 1))
+                paused, previous = await pipe.execute()
+            if paused > 0:
+                return paused / 1000
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.incr(requests_key)
+                pipe.incrby(tokens_key, tokens)
+                pipe.expire(requests_key, 120)
+                pipe.expire(tokens_key, 120)
+                used_requests, used_tokens, _, _ = await pipe.execute()
+            weight = 1 - elapsed / 60
+            used_requests += weight * int(previous[0] or 0)
+            used_tokens += weight * int(previous[1] or 0)
+            if used_requests <= self.rpm and used_tokens <= self.tpm:
+                return 0
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.decr(requests_key)
+                pipe.decrby(tokens_key, tokens)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to take from the shared rate limit budget, waiting: {e}")
+            return 1.0
+        return max((used_requests - self.rpm) * 60 / self.rpm, (used_tokens - self.tpm) * 60 / self.tpm, 0.05)
+
+    async def pause(self, seconds: float):
+        try:
+            key = f"{self._prefix}:paused"
+            if await self._redis.pttl(key) < seconds * 1000:
+                await self._redis.set(key, "1", px=int(seconds * 1000))
+        except Exception as e:
+            logger.error(f"Failed to pause the shared rate limit budget: {e}")
+
+
+class FairScheduler:
+    """Grants calls to one OpenAI model within its budget, taking turns between chats.
+
+    Waiting calls are queued per chat and chats are served round-robin, so a
+    chat with dozens of queued phrases delays a single-call chat by at most one turn.
+    """
+
+    def __init__(self, name: str, bucket: TokenBucket | RedisBudget):
+        self.name = name
+        self._bucket = bucket
+        self._waiting: dict[int, deque] = {}
+        self._turns: deque[int] = deque()
+        self._dispatcher: asyncio.Task | None = None
+
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def acquire(self, chat_id: int, tokens: int):
+        grant = asyncio.get_running_loop().create_future()
+        if chat_id not in self._waiting:
+            self._waiting[chat_id] = deque()
+            self._turns.append(chat_id)
+        self._waiting[chat_id].append((grant, tokens))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await grant
+
+    async def _dispatch(self):
+        while self._turns:
+            chat_id = self._turns[0]
+            waiters = self._waiting[chat_id]
+            grant, tokens = waiters[0]
+            if not grant.done():
+                wait = await self._bucket.try_acquire(tokens)
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                grant.set_result(None)
+            waiters.popleft()
+            self._turns.popleft()
+            if waiters:
+                self._turns.append(chat_id)
+            else:
+                del self._waiting[chat_id]
+
+    async def run(self, tokens: int, func, *args, **kwargs):
+        """Calls `func` once the budget allows, retrying rate limit and transient errors with backoff."""
+        chat_id = current_chat_id.get()
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await self.acquire(chat_id, tokens)
+            try:
+                return await func(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = retry_after(e) or RATE_LIMIT_BACKOFF * 2 ** attempt * (1 + random.random())
+                logger.warning(f"{self.name} call failed (attempt {attempt + 1}), retrying in {delay:.1f}s: {e}")
+                if isinstance(e, openai.RateLimitError):
+                    # everyone waits, the budget is shared by the whole API key
+                    await self._bucket.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+
+def create_budget(name: str, rpm: int, tpm: int, backend: str = RATE_LIMIT_BACKEND):
+    logger.info(f"Using {backend} rate limit budget for {name}")
+    if backend == "local":
+        return TokenBucket(rpm, tpm)
+    if backend == "redis":
+        return RedisBudget(redis_client(), name, rpm, tpm)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+chat_scheduler = FairScheduler("chat", create_budget("chat", CHAT_RPM, CHAT_TPM))
+tts_scheduler = FairScheduler("tts", create_budget("tts", TTS_RPM, TTS_TPM))
@@ -0,0 +1,28 @@
+import os
+import logging
+
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("ESSAY2ANKI_REDIS_URL", "redis://localhost:6379/0")
+# every key is prefixed, so several deployments can share one server
+REDIS_PREFIX = os.getenv("ESSAY2ANKI_REDIS_PREFIX", "essay2anki:")
+
+_client: redis.asyncio.Redis | None = None
+
+
+def redis_client() -> redis.asyncio.Redis:
+    """Process-wide asyncio client, shared by the stores and the update queue."""
+    global _client
+    if _client is None:
+        logger.info(f"Connecting to Redis at {REDIS_URL}")
+        _client = redis.asyncio.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _client
+
+
+async def close_redis_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,215 @@
+import os
+import abc
+import json
+import sqlite3
+import logging
+import threading
+
+from redis_client import redis_client, REDIS_PREFIX
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_BACKEND = os.getenv("ESSAY2ANKI_SETTINGS_BACKEND", "json")
+SETTINGS_SQLITE_PATH = os.getenv("ESSAY2ANKI_SETTINGS_SQLITE_PATH", "chats/settings.sqlite3")
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("ESSAY2ANKI_SETTINGS_FLUSH_INTERVAL", "1.0"))
+
+
+class BaseSettingsStore(abc.ABC):
+    """Per-chat settings, which the bot merges over its defaults.
+
+    The methods are coroutines, as with a shared store they are a network round trip.
+    """
+
+    @abc.abstractmethod
+    async def get(self, chat_id: int) -> dict:
+        pass
+
+    @abc.abstractmethod
+    async def update(self, chat_id: int, **changes):
+        pass
+
+    @abc.abstractmethod
+    async def reset(self, chat_id: int):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SettingsStore(BaseSettingsStore):
+    """Per-chat settings kept in memory and flushed to a backend in batches.
+
+    Reads are served from memory after the first load of a chat. Changes are
+    merged under a lock and written out by a background flusher every
+    `flush_interval` seconds, or immediately if the interval is 0. Subclasses
+    implement the storage in `_load`, `_write` and `_delete`.
+    """
+
+    def __init__(self, flush_interval: float):
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._settings: dict[int, dict] = {}
+        self._dirty: set[int] = set()
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name="settings-flusher", daemon=True)
+            self._flusher.start()
+
+    async def get(self, chat_id: int) -> dict:
+        with self._lock:
+            if chat_id not in self._settings:
+                self._settings[chat_id] = self._load(chat_id) or {}
+            return dict(self._settings[chat_id])
+
+    async def update(self, chat_id: int, **changes):
+        with self._lock:
+            if chat_id not in self._settings:
+                self._settings[chat_id] = self._load(chat_id) or {}
+            self._settings[chat_id].update(changes)
+            self._dirty.add(chat_id)
+        if not self._flusher:
+            self.flush()
+
+    async def reset(self, chat_id: int):
+        with self._write_lock, self._lock:
+            self._settings[chat_id] = {}
+            self._dirty.discard(chat_id)
+            self._delete(chat_id)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                batch = {chat_id: dict(self._settings[chat_id]) for chat_id in self._dirty}
+                self._dirty.clear()
+            if batch:
+                self._write(batch)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush settings: {e}", exc_info=True)
+
+    async def close(self):
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush()
+
+    @abc.abstractmethod
+    def _load(self, chat_id: int) -> dict | None:
+        pass
+
+    @abc.abstractmethod
+    def _write(self, batch: dict[int, dict]):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, chat_id: int):
+        pass
+
+
+class JsonSettingsStore(SettingsStore):
+    """Stores settings of every chat in `chats/<id>/settings.json`."""
+
+    def __init__(self, flush_interval: float, root: str = "chats"):
+        self._root = root
+        super().__init__(flush_interval)
+
+    def _path(self, chat_id: int) -> str:
+        return os.path.join(self._root, str(chat_id), "settings.json")
+
+    def _load(self, chat_id: int) -> dict | None:
+        try:
+            with open(self._path(chat_id), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            logger.error(f"Corrupted settings of chat {chat_id}, using defaults: {e}")
+            return None
+
+    def _write(self, batch: dict[int, dict]):
+        for chat_id, settings in batch.items():
+            path = self._path(chat_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(settings, f)
+            os.replace(f"{path}.tmp", path)
+
+    def _delete(self, chat_id: int):
+        try:
+            os.remove(self._path(chat_id))
+        except FileNotFoundError:
+            pass
+
+
+class SqliteSettingsStore(SettingsStore):
+    """Stores settings of all chats in a single SQLite file."""
+
+    def __init__(self, flush_interval: float, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS settings (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        super().__init__(flush_interval)
+
+    def _load(self, chat_id: int) -> dict | None:
+        with self._db_lock:
+            row = self._db.execute("SELECT data FROM settings WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, batch: dict[int, dict]):
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO settings (chat_id, data) VALUES (?, ?)",
+                [(chat_id, json.dumps(settings)) for chat_id, settings in batch.items()]
+            )
+
+    def _delete(self, chat_id: int):
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM settings WHERE chat_id = ?", (chat_id,))
+
+
+class RedisSettingsStore(BaseSettingsStore):
+    """Stores settings of every chat in a Redis hash, shared by all instances of the bot.
+
+    Nothing is kept in memory, as another instance may change the settings at
+    any time, and every change is written through at once, field by field.
+    """
+
+    def __init__(self, client):
+        self._redis = client
+
+    def _key(self, chat_id: int) -> str:
+        return f"{REDIS_PREFIX}settings:{chat_id}"
+
+    async def get(self, chat_id: int) -> dict:
+        return {name: json.loads(value) for name, value in (await self._redis.hgetall(self._key(chat_id))).items()}
+
+    async def update(self, chat_id: int, **changes):
+        if changes:
+            await self._redis.hset(self._key(chat_id), mapping={name: json.dumps(value) for name, value in changes.items()})
+
+    async def reset(self, chat_id: int):
+        await self._redis.delete(self._key(chat_id))
+
+
+def create_settings_store(backend: str = SETTINGS_BACKEND) -> BaseSettingsStore:
+    logger.info(f"Using {backend} settings store")
+    if backend == "json":
+        return JsonSettingsStore(SETTINGS_FLUSH_INTERVAL)
+    if backend == "sqlite":
+        return SqliteSettingsStore(SETTINGS_FLUSH_INTERVAL, SETTINGS_SQLITE_PATH)
+    if backend == "redis":
+        return RedisSettingsStore(redis_client())
+    raise ValueError(f"Unknown settings backend: {backend}")
+
+
+settings_store = create_settings_store()
@@ -0,0 +1,215 @@
+"""Regression tests of the Redis update queue against the local Redis stand-in.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "bench")]
+
+import redis.asyncio
+
+import fake_redis
+from redis_client import REDIS_PREFIX
+from update_queue import RedisUpdateQueue
+
+LEASE_TIMEOUT = 0.6
+SIZE_KEY = f"{REDIS_PREFIX}updates:size"
+READY_KEY = f"{REDIS_PREFIX}updates:ready"
+
+
+def update(update_id: int, chat_id: int) -> dict:
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": str(update_id)}}
+
+
+async def hang(update: dict):
+    await asyncio.Event().wait()
+
+
+class RedisUpdateQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server, self.fake = await fake_redis.serve(port=0)
+        self.url = f"redis://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/0?protocol=2"
+        self.clients = []
+        self.runs = []
+        self.handled: dict[int, list[int]] = {}
+        self.receiver = self.queue(self.handle, workers=0)
+        # lets commands that were made to never answer finish, so that the server can close
+        self.unblocked = asyncio.Event()
+
+    async def asyncTearDown(self):
+        self.unblocked.set()
+        for run in self.runs:
+            run.cancel()
+        await asyncio.gather(*self.runs, return_exceptions=True)
+        for client in self.clients:
+            await client.aclose()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def queue(self, handler, workers: int = 2) -> RedisUpdateQueue:
+        client = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+        self.clients.append(client)
+        return RedisUpdateQueue(client, handler, workers, 1000, LEASE_TIMEOUT)
+
+    def start(self, queue: RedisUpdateQueue):
+        run = asyncio.create_task(queue.run())
+        self.runs.append(run)
+        return run
+
+    async def kill(self, queue: RedisUpdateQueue, run: asyncio.Task):
+        """Stops a worker the way a crash would, without giving up anything it holds."""
+        for task in [*queue._tasks, run]:
+            task.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+
+    async def handle(self, update: dict):
+        await asyncio.sleep(random.random() * 0.01)
+        self.handled.setdefault(update["message"]["chat"]["id"], []).append(update["update_id"])
+
+    async def wait_until(self, condition, timeout: float = 10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            await asyncio.sleep(0.05)
+
+    async def size(self) -> int:
+        return int(await self.clients[0].get(SIZE_KEY) or 0)
+
+    def fail_once(self, command: str, key: str, error: Exception | None = None):
+        """Makes the next `command` on `key` fail with `error`, or never answer without one."""
+        original = getattr(self.fake, f"cmd_{command}")
+
+        async def failing(*args):
+            if args[0] != key:
+                return original(*args)
+            setattr(self.fake, f"cmd_{command}", original)
+            if error is None:
+                await self.unblocked.wait()
+                raise ConnectionError("ERR connection lost")
+            raise error
+
+        setattr(self.fake, f"cmd_{command}", failing)
+
+    async def test_updates_of_a_chat_are_handled_in_order_one_at_a_time(self):
+        active, overlaps = set(), []
+
+        async def handler(update):
+            chat_id = update["message"]["chat"]["id"]
+            if chat_id in active:
+                overlaps.append(chat_id)
+            active.add(chat_id)
+            try:
+                await self.handle(update)
+            finally:
+                active.discard(chat_id)
+
+        for _ in range(3):
+            self.start(self.queue(handler, workers=3))
+        for update_id in range(200):
+            self.assertTrue(await self.receiver.submit(update(update_id, random.randint(1, 10))))
+            if update_id % 10 == 0:
+                await asyncio.sleep(0.01)
+        await self.wait_until(lambda: sum(map(len, self.handled.values())) == 200)
+        self.assertEqual(overlaps, [])
+        for update_ids in self.handled.values():
+            self.assertEqual(update_ids, sorted(update_ids))
+        self.assertEqual(await self.size(), 0)
+
+    async def test_update_of_a_dead_worker_is_handled_by_another(self):
+        started = []
+
+        async def dying(update):
+            started.append(update["update_id"])
+            await hang(update)
+
+        queue = self.queue(dying)
+        run = self.start(queue)
+        await self.receiver.submit(update(1, 5))
+        await self.receiver.submit(update(2, 5))
+        await self.wait_until(lambda: started)
+        await self.kill(queue, run)
+
+        self.start(self.queue(self.handle))
+        await self.wait_until(lambda: len(self.handled.get(5, [])) == 2)
+        self.assertEqual(self.handled[5], [1, 2])
+        self.assertEqual(await self.size(), 0)
+
+    async def test_update_that_kills_its_worker_twice_is_dropped(self):
+        started = []
+
+        async def dying(update):
+            started.append(update["update_id"])
+            await hang(update)
+
+        await self.receiver.submit(update(1, 5))
+        await self.receiver.submit(update(2, 5))
+        for attempt in (1, 2):
+            queue = self.queue(dying)
+            run = self.start(queue)
+            await self.wait_until(lambda: len(started) == attempt)
+            await self.kill(queue, run)
+        self.assertEqual(started, [1, 1])
+
+        self.start(self.queue(self.handle))
+        await self.wait_until(lambda: 5 in self.handled)
+        self.assertEqual(self.handled[5], [2])
+        self.assertEqual(await self.size(), 0)
+
+    async def test_handling_stops_before_a_lease_that_cannot_be_renewed_expires(self):
+        started, cancelled = [], []
+
+        async def slow(update):
+            started.append(time.monotonic())
+            try:
+                await hang(update)
+            except asyncio.CancelledError:
+                cancelled.append(time.monotonic())
+                raise
+
+        self.start(self.queue(slow))
+        await self.receiver.submit(update(1, 5))
+        await self.wait_until(lambda: started)
+        original = self.fake.cmd_zadd
+
+        def failing(key, *args):
+            if "XX" in args:
+                raise ConnectionError("ERR renewal refused")
+            return original(key, *args)
+
+        self.fake.cmd_zadd = failing
+        await self.wait_until(lambda: cancelled)
+        self.assertLess(cancelled[0] - started[0], LEASE_TIMEOUT)
+        self.assertEqual(await self.size(), 1)
+
+    async def test_chat_is_handled_after_a_redis_error_mid_claim(self):
+        # the lease is taken but the chat cannot be taken out of `ready`
+        self.fail_once("zrem", READY_KEY, ConnectionError("ERR connection lost"))
+        self.start(self.queue(self.handle, workers=1))
+        await self.receiver.submit(update(1, 5))
+        await self.wait_until(lambda: 5 in self.handled)
+        self.assertEqual(self.handled[5], [1])
+        self.assertEqual(await self.size(), 0)
+
+    async def test_chat_is_handled_after_a_worker_dies_mid_claim(self):
+        # the worker dies holding the lease of a chat it never got to
+        self.fail_once("zrem", READY_KEY)
+        queue = self.queue(self.handle, workers=1)
+        run = self.start(queue)
+        await self.receiver.submit(update(1, 5))
+        await self.wait_until(lambda: self.fake.cmd_zrem.__name__ == "cmd_zrem")
+        await self.kill(queue, run)
+
+        self.start(self.queue(self.handle))
+        await self.wait_until(lambda: 5 in self.handled)
+        self.assertEqual(self.handled[5], [1])
+        self.assertEqual(await self.size(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
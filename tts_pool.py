@@ -0,0 +1,39 @@
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+TTS_CONCURRENCY = int(os.getenv("ESSAY2ANKI_TTS_CONCURRENCY", "8"))
+TTS_CHAT_CONCURRENCY = int(os.getenv("ESSAY2ANKI_TTS_CHAT_CONCURRENCY", "4"))
+
+
+class SpeechPool:
+    """Runs speech synthesis jobs concurrently, bounded globally and per chat.
+
+    A job first waits for a slot of its chat and only then for a global one,
+    so one long essay cannot take all global slots and starve other chats.
+    Failed calls are not retried here, `FairScheduler.run` owns the retry policy.
+    """
+
+    def __init__(self, max_concurrency: int, per_chat: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._per_chat = max(1, per_chat)
+        self._chats: dict[int, list] = {}
+
+    def submit(self, chat_id: int, func, *args) -> asyncio.Task:
+        return asyncio.create_task(self._run(chat_id, func, args))
+
+    async def _run(self, chat_id: int, func, args):
+        chat = self._chats.setdefault(chat_id, [asyncio.Semaphore(self._per_chat), 0])
+        chat[1] += 1
+        try:
+            async with chat[0], self._semaphore:
+                return await func(*args)
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[chat_id]
+
+
+speech_pool = SpeechPool(TTS_CONCURRENCY, TTS_CHAT_CONCURRENCY)
@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+from redis_client import redis_client, REDIS_PREFIX
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = int(os.getenv("ESSAY2ANKI_UPDATE_WORKERS", "64"))
+UPDATE_QUEUE_SIZE = int(os.getenv("ESSAY2ANKI_UPDATE_QUEUE_SIZE", "256"))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("ESSAY2ANKI_UPDATE_DRAIN_TIMEOUT", "60"))
+QUEUE_BACKEND = os.getenv("ESSAY2ANKI_QUEUE_BACKEND", "local")
+UPDATE_LEASE_TIMEOUT = float(os.getenv("ESSAY2ANKI_UPDATE_LEASE_TIMEOUT", "60"))
+
+
+def update_chat_id(update: dict) -> int | None:
+    """Extracts the chat id from a raw Telegram update, if it has one."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    callback_query = update.get("callback_query")
+    if callback_query and callback_query.get("message"):
+        return callback_query["message"]["chat"]["id"]
+    return None
+
+
+class UpdateQueue:
+    """Bounded queue of Telegram updates processed by at most `workers` concurrent tasks.
+
+    Every chat with pending updates gets its own task that handles them one at
+    a time, so updates of a chat are processed in the order they were received.
+    """
+
+    def __init__(self, handler, workers: int, max_size: int):
+        self._handler = handler
+        self._semaphore = asyncio.Semaphore(workers)
+        self._max_size = max_size
+        self._size = 0
+        self._chats: dict[int, deque] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._closed = False
+
+    def start(self):
+        self._closed = False
+
+    async def submit(self, update: dict) -> bool:
+        """Enqueues an update, returns False if the queue is full and the update should be redelivered later."""
+        if self._closed or self._size >= self._max_size:
+            logger.warning(f"Update queue is not accepting updates, rejecting update {update.get('update_id')}")
+            return False
+        self._size += 1
+        chat_id = update_chat_id(update) or 0
+        if chat_id in self._chats:
+            self._chats[chat_id].append(update)
+        else:
+            self._chats[chat_id] = deque([update])
+            task = asyncio.create_task(self._work(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return True
+
+    def qsize(self) -> int:
+        return self._size
+
+    async def _work(self, chat_id: int):
+        pending = self._chats[chat_id]
+        while pending:
+            update = pending.popleft()
+            try:
+                async with self._semaphore:
+                    await self._handler(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.get('update_id')}: {e}", exc_info=True)
+            finally:
+                self._size -= 1
+        del self._chats[chat_id]
+
+    async def stop(self, timeout: float):
+        """Stops accepting updates and lets everything already queued finish, waiting at most `timeout` seconds."""
+        self._closed = True
+        logger.info(f"Draining {self.qsize()} queued updates...")
+        if not self._tasks:
+            return
+        _, unfinished = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            logger.warning(f"{len(unfinished)} chats did not finish in time")
+
+
+class RedisUpdateQueue:
+    """Update queue in Redis, shared by webhook receivers and workers on any number of nodes.
+
+    Updates wait in a list per chat, and a chat with updates nobody has taken
+    yet waits in the `ready` set. A worker takes a chat by creating its lease,
+    which only one worker can do, and only then removes it from `ready`, so a
+    chat is never lost between the two. The owner handles the chat's updates
+    in order until its list is empty. An update stays at the head of the list
+    until it has been handled, and is removed together with its count in `size`.
+
+    Owners renew their leases and give up an update whose lease they cannot
+    renew in time. Once the lease of a worker that died expires, its chat goes
+    back to `ready` and the update it was handling is handled again. An update
+    whose handling was interrupted twice is dropped, so that one that kills its
+    worker cannot take down every worker in turn.
+    """
+
+    def __init__(self, client, handler, workers: int, max_size: int, lease_timeout: float):
+        self._redis = client
+        self._handler = handler
+        self._workers = workers
+        self._max_size = max_size
+        self._lease_timeout = lease_timeout
+        self._size = 0
+        self._closed = False
+        self._tasks: set[asyncio.Task] = set()
+        self._size_key = f"{REDIS_PREFIX}updates:size"
+        self._ready_key = f"{REDIS_PREFIX}updates:ready"
+        self._wakeup_key = f"{REDIS_PREFIX}updates:wakeup"
+        self._leases_key = f"{REDIS_PREFIX}updates:leases"
+
+    def _chat_key(self, chat_id: int) -> str:
+        return f"{REDIS_PREFIX}updates:chat:{chat_id}"
+
+    def _attempts_key(self, chat_id: int) -> str:
+        return f"{REDIS_PREFIX}updates:attempts:{chat_id}"
+
+    def _announce(self, pipe, chat_ids: list):
+        """Queues the commands that hand chats to whichever worker takes them first."""
+        pipe.zadd(self._ready_key, {chat_id: time.time() for chat_id in chat_ids}, nx=True)
+        pipe.rpush(self._wakeup_key, *chat_ids)
+        # wakeups only save idle workers a poll, the ones nobody waited for are not worth keeping
+        pipe.ltrim(self._wakeup_key, -self._max_size, -1)
+
+    def start(self):
+        self._closed = False
+
+    async def submit(self, update: dict) -> bool:
+        """Enqueues an update, returns False if the queue is full and the update should be redelivered later.
+
+        The bound is checked before the update is added, so concurrent submissions may overshoot it slightly.
+        """
+        if self._closed:
+            return False
+        self._size = int(await self._redis.get(self._size_key) or 0)
+        if self._size >= self._max_size:
+            logger.warning(f"Update queue is full, rejecting update {update.get('update_id')}")
+            return False
+        chat_id = update_chat_id(update) or 0
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(self._chat_key(chat_id), json.dumps(update))
+            pipe.incr(self._size_key)
+            # the owner of the chat, if any, takes it out of `ready` before looking for its next update
+            self._announce(pipe, [chat_id])
+            _, self._size, *_ = await pipe.execute()
+        return True
+
+    def qsize(self) -> int:
+        """Size of the queue across all instances, as last seen by this one."""
+        return self._size
+
+    async def run(self):
+        """Processes queued updates with `workers` concurrent chats until stopped."""
+        self.start()
+        tasks = [asyncio.create_task(self._consume()) for _ in range(self._workers)]
+        tasks.append(asyncio.create_task(self._recover_periodically()))
+        self._tasks.update(tasks)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _consume(self):
+        while not self._closed:
+            try:
+                chat_id = await self._claim()
+                if chat_id is None:
+                    await self._redis.blpop(self._wakeup_key, timeout=1)
+                else:
+                    await self._work(chat_id)
+            except Exception as e:
+                logger.error(f"Error consuming updates: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def _claim(self) -> int | None:
+        """Takes the chat that has been waiting the longest and is not owned, if any."""
+        chat_ids = await self._redis.zrange(self._ready_key, 0, self._max_size - 1)
+        if not chat_ids:
+            return None
+        # a chat that got an update while owned stays in `ready` until its owner gets to it
+        leases = await self._redis.zmscore(self._leases_key, chat_ids)
+        for chat_id, lease in zip(chat_ids, leases):
+            if lease is None and await self._redis.zadd(self._leases_key, {chat_id: time.time() + self._lease_timeout}, nx=True):
+                return int(chat_id)
+        return None
+
+    async def _work(self, chat_id: int):
+        while not self._closed:
+            expires_at = time.time() + self._lease_timeout
+            # XX: a lease that was recovered in the meantime must not be recreated
+            if not await self._redis.zadd(self._leases_key, {chat_id: expires_at}, xx=True, ch=True):
+                logger.error(f"Lost the lease of chat {chat_id}, leaving it to its next owner")
+                return
+            # every update announced so far is in the list and gets handled below
+            await self._redis.zrem(self._ready_key, chat_id)
+            raw = await self._redis.lindex(self._chat_key(chat_id), 0)
+            if raw is None:
+                # an update submitted from now on announces the chat again
+                await self._redis.zrem(self._leases_key, chat_id)
+                return
+            update = json.loads(raw)
+            attempts = await self._redis.hincrby(self._attempts_key(chat_id), update.get("update_id", 0), 1)
+            await self._redis.expire(self._attempts_key(chat_id), 24 * 60 * 60)
+            if attempts > 2:
+                logger.error(f"Dropping an update of chat {chat_id} whose handling was interrupted twice: {raw}")
+                await self._pop(chat_id, update)
+                continue
+            handling = asyncio.create_task(self._handler(update))
+            lease = asyncio.create_task(self._keep_lease(chat_id, expires_at, handling))
+            try:
+                await asyncio.wait([handling])
+            finally:
+                lease.cancel()
+                # when the worker is stopped the update stays queued for whoever recovers the chat
+                handling.cancel()
+            if handling.cancelled():
+                logger.error(f"Lost the lease of chat {chat_id}, leaving update {update.get('update_id')} to its next owner")
+                return
+            if handling.exception():
+                e = handling.exception()
+                logger.error(f"Error processing update {update.get('update_id')}: {e}", exc_info=e)
+            await self._pop(chat_id, update)
+        # another worker carries on with the rest of the chat's updates
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._leases_key, chat_id)
+            self._announce(pipe, [chat_id])
+            await pipe.execute()
+
+    async def _pop(self, chat_id: int, update: dict):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lpop(self._chat_key(chat_id))
+            pipe.decr(self._size_key)
+            pipe.hdel(self._attempts_key(chat_id), update.get("update_id", 0))
+            _, self._size, _ = await pipe.execute()
+
+    async def _keep_lease(self, chat_id: int, expires_at: float, handling: asyncio.Task):
+        """Renews the lease of a chat while its update is handled, cancels the handling once the lease is lost."""
+        interval = self._lease_timeout / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                renewed_until = time.time() + self._lease_timeout
+                if not await self._redis.zadd(self._leases_key, {chat_id: renewed_until}, xx=True, ch=True):
+                    logger.error(f"Lease of chat {chat_id} was taken over")
+                    handling.cancel()
+                    return
+                expires_at = renewed_until
+            except Exception as e:
+                logger.error(f"Failed to renew the lease of chat {chat_id}: {e}", exc_info=True)
+                # give the chat up before another worker can take it over
+                if time.time() + interval >= expires_at:
+                    handling.cancel()
+                    return
+
+    async def _recover_periodically(self):
+        while not self._closed:
+            await asyncio.sleep(min(self._lease_timeout / 3, 1))
+            try:
+                now = time.time()
+                expired = await self._redis.zrangebyscore(self._leases_key, "-inf", now)
+                if not expired:
+                    continue
+                logger.warning(f"Leases of chats {', '.join(expired)} expired, handing them to other workers")
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    # a lease renewed in the meantime is kept, and its chat taken out of `ready` by its owner
+                    pipe.zremrangebyscore(self._leases_key, "-inf", now)
+                    self._announce(pipe, expired)
+                    await pipe.execute()
+            except Exception as e:
+                logger.error(f"Error recovering chats: {e}", exc_info=True)
+
+    async def stop(self, timeout: float):
+        """Stops taking updates and lets the ones being handled finish, waiting at most `timeout` seconds."""
+        self._closed = True
+        if not self._tasks:
+            return
+        _, unfinished = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            logger.warning(f"{len(unfinished)} workers did not finish in time")
+
+
+def create_update_queue(handler, backend: str = QUEUE_BACKEND):
+    logger.info(f"Using {backend} update queue")
+    if backend == "local":
+        return UpdateQueue(handler, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+    if backend == "redis":
+        return RedisUpdateQueue(redis_client(), handler, UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_LEASE_TIMEOUT)
+    raise ValueError(f"Unknown update queue backend: {backend}")
@@ -0,0 +1,52 @@
+import os
+import signal
+import asyncio
+import logging
+
+from bot import warm_up, close_bot, handle_webhook
+from update_queue import create_update_queue, UPDATE_DRAIN_TIMEOUT, QUEUE_BACKEND
+from settings_store import settings_store
+from redis_client import close_redis_client
+from rate_limiter import chat_scheduler, tts_scheduler
+import metrics
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+WORKER_METRICS_PORT = int(os.getenv("ESSAY2ANKI_WORKER_METRICS_PORT", "0"))
+
+
+async def main():
+    """Processes the updates that webhook receivers (app.py) put on the shared queue."""
+    # the bot, the receivers and the workers must agree on the backend, e.g. for what collect mode offers
+    if QUEUE_BACKEND != "redis":
+        raise SystemExit("worker.py processes the shared update queue, set ESSAY2ANKI_QUEUE_BACKEND=redis")
+    logger.info("Starting Essay2Anki worker...")
+    update_queue = create_update_queue(handle_webhook)
+    metrics.UPDATE_QUEUE_SIZE.set_function(update_queue.qsize)
+    metrics.SCHEDULER_QUEUED.labels("chat").set_function(chat_scheduler.queued)
+    metrics.SCHEDULER_QUEUED.labels("tts").set_function(tts_scheduler.queued)
+    if WORKER_METRICS_PORT:
+        metrics.serve(WORKER_METRICS_PORT)
+
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stopping.set)
+    await warm_up()
+    running = asyncio.create_task(update_queue.run())
+    await stopping.wait()
+
+    logger.info("Shutting down Essay2Anki worker...")
+    await update_queue.stop(UPDATE_DRAIN_TIMEOUT)
+    await running
+    await settings_store.close()
+    await close_redis_client()
+    await close_bot()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())